@@ -5,6 +5,9 @@
 # logging output from wps:
 [ -e /var/www/wps/ ] || mkdir /var/www/wps/
 chown www-data:www-data /var/www/wps/
+# status documents of asynchronous wps executions (see outputPath in pywps.cfg):
+[ -e /var/www/wps/wpsoutputs/ ] || mkdir /var/www/wps/wpsoutputs/
+chown www-data:www-data /var/www/wps/wpsoutputs/
 
 MYIP=$(grep ${HOSTNAME} /etc/hosts | awk '{print $1}'); export MYIP
 
@@ -31,11 +31,16 @@ import string
 import time
 
 # list of indicators to calculate for each new worldstate
-indicators = ['PatientHealth', 'Deaths', 'Improved', 'ResourceDepleted', 'EffectiveResponse', 'Evacuation', 'UnusedResources']
+# AllIndicators calculates 'PatientHealth', 'Deaths', 'Improved', 'ResourceDepleted', 'EffectiveResponse', 'Evacuation', 'UnusedResources'
+# with one execution (see processes/AllIndicators.py)
+indicators = ['AllIndicators']
 
 
 # WPS service
-wps = "http://localhost:80/cgi-bin/pywps.cgi?service=WPS&request=Execute&version=1.0.0&identifier={0}&datainputs=ICMMworldstateURL={1}"
+# asynchronous execution: the WPS answers with the status location at once and calculates in the background
+wps = "http://localhost:80/cgi-bin/pywps.cgi?service=WPS&request=Execute&version=1.0.0&identifier={0}&datainputs=ICMMworldstateURL={1}&storeExecuteResponse=true&status=true"
+# seconds to wait for the WPS to accept an indicator execution
+wpsTimeout = 30
 
 print "Content-Type: text/plain"    # HTML is following
 print                               # blank line, end of headers
@@ -71,8 +76,11 @@ for elem in elems:
             wsURL = value["URI"]
             for indicator in indicators:
                 print >>sys.stderr, "Start indicator {0} for {1}".format (indicator, wsURL)
-                response = requests.get(wps.format (indicator, wsURL))
-                print >>sys.stderr, response.text
+                try:
+                    response = requests.get(wps.format (indicator, wsURL), timeout=wpsTimeout)
+                    print >>sys.stderr, response.text
+                except requests.exceptions.RequestException, e:
+                    print >>sys.stderr, "Indicator {0} for {1} failed: {2}".format (indicator, wsURL, e)
             
 
 exit (0)
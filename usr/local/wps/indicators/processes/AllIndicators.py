@@ -0,0 +1,146 @@
+"""
+The server gets an ICMM worldstate URL and calculates all indicators and KPI with one execution
+
+Execution example (Change service part):
+http://crisma.ait.ac.at/indicators/pywps.cgi?service=WPS&request=Execute&version=1.0.0&identifier=AllIndicators&datainputs=ICMMworldstateURL=http://crisma.cismet.de/pilotC/icmm_api/CRISMA.worldstates/2
+
+The ICMM and OOI WorldState are resolved once, the OOI data needed by the
+indicators is loaded once and shared, and all indicator values and KPI are
+written with one update each (instead of one WPS execution per indicator).
+
+Adding an indicator: add it to the list of indicators below. The inputs
+it declares (requires) are loaded together with the inputs of the others.
+
+
+This programm needs an recent requests library:
+pip install requests --upgrade
+"""
+
+"""
+    Copyright (C) 2014  AIT / Austrian Institute of Technology
+    http://www.ait.ac.at
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as
+    published by the Free Software Foundation, either version 2 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/gpl-2.0.html
+"""
+
+
+from pywps.Process import WPSProcess
+from sys import stderr
+import json
+import time
+import logging
+import copy
+
+from crisma.Indicator import Indicator, DataPlan
+import crisma.HTTPtools as HTTP
+import crisma.ICMMtools as ICMM
+import crisma.OOItools as OOI
+import crisma.ThreadPool as ThreadPool
+
+######################
+#  Configuration
+# indicators to calculate, in this order the KPI are merged (as OrionListener did)
+indicators = ['PatientHealth', 'Deaths', 'Improved', 'ResourceDepleted', 'EffectiveResponse', 'Evacuation', 'UnusedResources']
+parallel = True           # calculate the indicators at the same time
+#####################
+
+class Process(Indicator):
+    def __init__(self):
+        # init process
+        Indicator.__init__(
+            self,
+            identifier="AllIndicators", #the same as the file name
+            version = "1.0",
+            title="All indicators",
+            abstract="""Calculates all indicators and KPI of a worldstate with one shared data load: {0}""".format (", ".join (indicators)))
+
+    def codeVersion (self):
+        """a changed indicator invalidates the stored result, too"""
+        return ",".join ([Indicator.codeVersion (self)] + [__import__ (name).Process ().codeVersion () for name in indicators])
+
+    def inputPlan (self):
+        """inputs of all indicators"""
+        return DataPlan ([__import__ (name).Process () for name in indicators])
+
+    def calculateMember (self, member):
+        """calculateIndicator of one indicator, errors are logged like in Indicator.execute"""
+        logging.info ("calculate {0}".format (member.identifier))
+        try:
+            error = member.calculateIndicator ()
+            if error is not None:
+                logging.error ("{0}: calculateIndicator: {1}".format (member.identifier, error))
+                return error
+            return "OK"
+        except HTTP.DeadlineExceeded:
+            raise
+        except Exception, e:
+            logging.exception ("{0}: calculateIndicator: {1}".format (member.identifier, str(e.args)))
+            return "calculateIndicator: {0}".format (str(e.args))
+
+    def calculateIndicator(self):
+        self.result = {}
+        self.status.set("Start collecting input data", 20)
+
+        # the indicators share the ICMM / OOI WorldState resolved by this process
+        members = []
+        for name in indicators:
+            member = __import__ (name).Process ()
+            member.ICMMworldstate = self.ICMMworldstate
+            member.worldstateSnapshot = self.worldstateSnapshot
+            member.worldstateDescription = copy.deepcopy (self.worldstateDescription)
+            member.OOIworldstate = self.OOIworldstate
+            members.append (member)
+
+        # one load of the inputs of all indicators
+        self.loadInputs (DataPlan (members))
+        for member in members:
+            member.parents = self.parents
+            member.baseOOIworldstate = self.baseOOIworldstate
+            member.simulatedTimes = self.simulatedTimes
+            member.chainEtpids = self.chainEtpids
+            member.ooiWorldstates = self.ooiWorldstates
+        self.status.set("Got input data data", 30)
+
+        if parallel:
+            calculations = [ThreadPool.submit (self.calculateMember, member) for member in members]
+            ThreadPool.wait (calculations)
+            messages = [calculation.result () for calculation in calculations]
+        else:
+            messages = [self.calculateMember (member) for member in members]
+        self.status.set("Calculated {0} indicators".format (len (members)), 80)
+
+        # all indicator values and KPI, written by Indicator.execute with one update each
+        values = []
+        kpi = {}
+        failed = []
+        for (member, message) in zip (members, messages):
+            if message != "OK":
+                failed.append ("{0}: {1}".format (member.identifier, message))
+            if member.result is None:
+                continue
+            if 'indicator' in member.result:
+                if isinstance (member.result['indicator'], list):
+                    values.extend (member.result['indicator'])
+                if isinstance (member.result['indicator'], dict):
+                    # contains 'id': identifier, 'name': title of the indicator
+                    values.append (member.result['indicator'])
+            if 'kpi' in member.result:
+                ICMM.mergeKpi (kpi, copy.deepcopy (member.result['kpi']))
+        self.result = {
+            'indicator': values,
+            'kpi': kpi
+            }
+        if len (failed) > 0:
+            raise Exception ("; ".join (failed))
+        return
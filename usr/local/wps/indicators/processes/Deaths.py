@@ -66,7 +66,8 @@ class Process(Indicator):
 
 indicator;Deaths;Number of fatalities;Number of patients with health less than 20;number
 kpi;Deaths;Number of fatalities;Number of patients with health less than 20;number
-""")
+""",
+            requires = {'actual': [OOI.patientLifePropertyId]})
 
 
     def calculateIndicator(self):
@@ -93,29 +94,22 @@ kpi;Deaths;Number of fatalities;Number of patients with health less than 20;numb
         numberOfDeaths = 0;
         requiredLifePropertyValue = 20;
 
-        params = {
-            'wsid' : self.OOIworldstate.id, 
-            'etpid' : OOI.patientLifePropertyId
-            }
-        jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
+        jsonData = OOI.getEntityProperties (self.OOIworldstate.id, OOI.patientLifePropertyId, baseUrl=self.OOIworldstate.endpoint)
 
         self.status.set("Got input data data", 21)
         self.status.set("Calculate indicator value", 30)
 
-        for ep in jsonData:
-            # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
-            if ep["entityTypeProperty"]['entityTypePropertyType'] != 1: 
-                logging.error ("Patient life property is not of type 1 (integer)!")
-                continue 
-            # The entityTypePropertyType might be a lie
-            try:
-                life = float (ep["entityPropertyValue"].replace (",", "."))
-                if life < requiredLifePropertyValue:
-                    numberOfDeaths += 1;
-            except:
-                logging.error ("Patient life property is not an integer: '{0}'".format (ep["entityPropertyValue"]))
-                # ignore problem !?!?
-                pass
+        table = OOI.PropertyTable (jsonData)
+        # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
+        wrongType = table.types != 1
+        if wrongType.sum () > 0:
+            logging.error ("{0} patient life properties are not of type 1 (integer)!".format (wrongType.sum ()))
+        # The entityTypePropertyType might be a lie
+        notNumber = ~wrongType & ~table.valid
+        if notNumber.sum () > 0:
+            logging.error ("Patient life property is not an integer: {0}".format (list (table.select (notNumber).values)))
+        life = table.select (~wrongType & table.valid).numbers
+        numberOfDeaths = int ((life < requiredLifePropertyValue).sum ())
         
         self.status.set("Calculated Deaths: {0}".format (numberOfDeaths), 40)
         
@@ -53,6 +53,7 @@ import logging
 from crisma.Indicator import Indicator
 import crisma.ICMMtools as ICMM
 import crisma.OOItools as OOI
+import crisma.ThreadPool as ThreadPool
 
 class Process(Indicator):
     def __init__(self):
@@ -70,7 +71,8 @@ kpi;EffectiveResponse;Effective Response;Percent of patients already treated;num
 kpi;IneffectiveResponse;Inffective Response;Percent of patients not already treated;number
 
 
-""")
+""",
+            requires = {'actual': [OOI.patientTreatmentStatePropertyId], 'baseline': [OOI.patientExposedPropertyId]})
 
 
     def calculateIndicator(self):
@@ -99,17 +101,9 @@ kpi;IneffectiveResponse;Inffective Response;Percent of patients not already trea
         # calculate indicator value
         self.status.set("Start collecting input data", 20)
 
-        # find out which pationts are part of the game
-        IDsToSkip = []
-        logging.info("Request list of patient IDs to be taken into account from base OOI WorldState = {0}".format (self.OOIworldstate.id))
-        params = {
-            'wsid' :  self.OOIworldstate.id, 
-            'etpid' : OOI.patientExposedPropertyId
-            }
-        jsonBaseData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
-        for ep in jsonBaseData:
-            if ep["entityPropertyValue"].lower() == "false":
-                IDsToSkip.append (ep["entityId"])
+        # actual data and the pationts part of the game (from the Baseline of the exercise) at the same time
+        properties = ThreadPool.submit (OOI.prefetch, self.OOIworldstate.id, [OOI.patientTreatmentStatePropertyId], baseUrl=self.OOIworldstate.endpoint)
+        baseline = self.getBaseline ()
 
 
         # overall number of properties
@@ -117,32 +111,20 @@ kpi;IneffectiveResponse;Inffective Response;Percent of patients not already trea
         # matching properties
         number = 0;
 
-        params = {
-            'wsid' : self.OOIworldstate.id, 
-            'etpid' : OOI.patientTreatmentStatePropertyId
-            }
-        jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
+        jsonData = properties.result ()[OOI.patientTreatmentStatePropertyId]
 
         self.status.set("Got input data data", 21)
         logging.info ("worldstate data: {0}".format (json.dumps (jsonData)))
         self.status.set("Calculate indicator value", 30)
 
-        for ep in jsonData:
-            if ep["entityId"] in IDsToSkip:
-                continue
-            totalCount += 1
-            # Needs to be a string. If not this is an error. Just silently skip to get an result anyway!
-            if ep["entityTypeProperty"]['entityTypePropertyType'] != 2: 
-                logging.error ("Property is not of type 2 (String)!")
-                continue 
-            # The entityTypePropertyType might be a lie
-            try:
-                if 'None' == ep["entityPropertyValue"]:
-                    number += 1;
-            except:
-                logging.error ("Property is not a number: '{0}'".format (ep["entityPropertyValue"]))
-                # ignore problem !?!?
-                pass
+        table = OOI.PropertyTable (jsonData)
+        table = table.select (baseline.participants (table))
+        totalCount = len (table)
+        # Needs to be a string. If not this is an error. Just silently skip to get an result anyway!
+        wrongType = table.types != 2
+        if wrongType.sum () > 0:
+            logging.error ("{0} properties are not of type 2 (String)!".format (wrongType.sum ()))
+        number = int ((~wrongType & table.valueIs ('None')).sum ())
         
         self.status.set("Calculated number: {0}; out of totalCount: {1}".format (number, totalCount), 40)
         
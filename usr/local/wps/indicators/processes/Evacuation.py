@@ -44,7 +44,7 @@ pip install requests --upgrade
 from pywps.Process import WPSProcess                                
 from sys import stderr
 import json
-import requests
+import crisma.HTTPtools as HTTP
 import urllib
 from xml.sax.saxutils import escape
 import time
@@ -72,26 +72,16 @@ indicator;TimeToEvacuation;Time to Evacuation;Minutes from start till evacuation
 indicator;LastPatientEvacuated;Last Patient Evacuated;Minutes from start till last patient is evacuated;number
 kpi;Evacuation;Evacuation completed;Minutes from start till last patient is evacuated;number
 
-""")
+""",
+            requires = {'chain': [OOI.vehicleAvailabilityPropertyId, OOI.vehicleResourceCommandId, OOI.patientTreatmentStatePropertyId], 'times': True})
 
-    def getTimeFromICMMws (self, wsid):
-        params = {
-            'level' :  1,
-            'fields' : "simulatedTime",
-            'omitNullValues' : 'true',
-            'deduplicate' : 'true'
+    def foldState (self, t1, t2, properties):
+        """State saved for the next worldstates: evacuation start and end found so far, actual EntityProperties"""
+        return {
+            't1': None if t1 == None else t1.isoformat (),
+            't2': None if t2 == None else t2.isoformat (),
+            'properties': properties
             }
-        headers = {'content-type': 'application/json'}
-        response = requests.get("{0}/{1}.{2}/{3}".format (self.ICMMworldstate.endpoint, self.ICMMworldstate.domain, "worldstates", wsid), params=params, headers=headers) 
-        if response.status_code != 200:
-            raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-        # Depending on the requests-version json might be an field instead of on method
-        jsonData = response.json() if callable (response.json) else response.json
-
-        ts = jsonData['simulatedTime']
-        if (len(ts) == 16):
-            ts = ts + ":00.0Z"
-        return dateutil.parser.parse (ts)
 
     def calculateIndicator(self):
         # Define values to be used if indicator can not be calculated (e.g. missing input data)
@@ -112,39 +102,40 @@ kpi;Evacuation;Evacuation completed;Minutes from start till last patient is evac
         
         self.status.set("Start collecting input data", 20)
         # find base WorldState from ICMM
-        parents = ICMM.getParentWorldstates (self.ICMMworldstate.id, baseCategory="Baseline", baseUrl=self.ICMMworldstate.endpoint)
+        parents = self.getParents ()
         if (parents is None):
             raise Exception ("Base ICMM WorldState not found for actual ICMM WorldState = {0}".format (self.ICMMworldstate))
 
         basewsid = parents[0]
 
         logging.info ("get start time from ws {0}".format (basewsid))
-        t0 = self.getTimeFromICMMws (basewsid)
+        t0 = self.getSimulatedTime (basewsid)
         t1 = None
         t2 = None
-        t3 = self.getTimeFromICMMws (self.ICMMworldstate.id)
-
-
-        for wsid in parents:
-            logging.info ("get ws {0}".format (wsid))
-            ooiWorldstateURL = ICMM.getOOIRef (wsid, 'OOI-worldstate-ref', baseUrl=self.ICMMworldstate.endpoint)
-            logging.info ("  ooiWorldstateURL = {0}".format (ooiWorldstateURL))
-            if (ooiWorldstateURL is None):
-                return "invalid OOI URL: {0}".format (ooiWorldstateURL)
-            # OOI-URL -> Endpoint, id, ...
-            ooiWorldstate = OOI.OOIAccess(ooiWorldstateURL)
-            # logging.info ("ooiWorldState = {0}".format (ooiWorldstate))
-            if (ooiWorldstate.endpoint is None):
-                return "invalid OOI ref: {0}".format (ooiWorldstate)
-        
-
-            logging.info("Request input data for OOI WorldState = {0}".format (ooiWorldstate.id))
-            params = {
-                'wsid' :  ooiWorldstate.id 
-                }
-            jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
-
-            # this now contaions ALL EntityPropertyIds !
+        t3 = self.getSimulatedTime (self.ICMMworldstate.id)
+
+        # continue with the state of the nearest parent worldstate already evaluated
+        # actual EntityProperties: "etpid/entityId" -> OOI.EntityPropertyRecord
+        properties = {}
+        (done, state) = self.loadFoldState (parents)
+        if state is not None:
+            t1 = None if state['t1'] is None else dateutil.parser.parse (state['t1'])
+            t2 = None if state['t2'] is None else dateutil.parser.parse (state['t2'])
+            properties = dict ((key, OOI.EntityPropertyRecord (ep)) for (key, ep) in state['properties'].items ())
+
+        # all OOI WorldStates are loaded in parallel, evaluated in order
+        # only the changes against the previous worldstate are loaded
+        needed = [OOI.vehicleAvailabilityPropertyId, OOI.vehicleResourceCommandId, OOI.patientTreatmentStatePropertyId]
+        worldstates = self.iterOOIWorldstates (parents[done:] if t2 == None else [], needed, parents[done - 1] if done > 0 else None)
+        for (index, (wsid, ooiWorldstate, changes, removed)) in enumerate (worldstates, done):
+            if (ooiWorldstate is None):
+                worldstates.close ()
+                return changes
+            for ep in changes:
+                properties["{0}/{1}".format (ep["entityTypePropertyId"], ep["entityId"])] = ep
+            for (entityId, etpid) in removed:
+                properties.pop ("{0}/{1}".format (etpid, entityId), None)
+            jsonData = properties.values ()
 
             # find out which vehicles are not part of the game
             IDsToSkip = []
@@ -153,7 +144,7 @@ kpi;Evacuation;Evacuation completed;Minutes from start till last patient is evac
                     if (OOI.vehicleAvailabilityPropertyId == ep["entityTypePropertyId"]) and (-1 == float (ep["entityPropertyValue"].replace (",", "."))):
                         IDsToSkip.append (ep["entityId"])
                 except Exception, e:
-                    logging.error ("problem {1} with EntityProperty {0}".format (json.dumps (ep), e))
+                    logging.error ("problem {1} with EntityProperty {0}".format (json.dumps (ep.asDict ()), e))
             logging.info ("IDsToSkip = {0]", IDsToSkip)
 
             # look for evacuation start (at least 1 vehicle with "evacuate" command)
@@ -171,7 +162,7 @@ kpi;Evacuation;Evacuation completed;Minutes from start till last patient is evac
                             if 'Command-Type' in command:
                                 if command['Command-Type'].lower() == 'evacuate':
                                     # hurray!
-                                    t1 = self.getTimeFromICMMws (wsid)
+                                    t1 = self.getSimulatedTime (wsid)
                                     break;
                         except:
                             raise Exception ("Problem understanding the command '{0}' (OOI wsid={1}, entityId={2})".format (ep['entityPropertyValue'], ooiWorldstate.id, ep["entityId"]))
@@ -194,8 +185,16 @@ kpi;Evacuation;Evacuation completed;Minutes from start till last patient is evac
                     
                 logging.info ("Patients still to evacuate: {0}".format (notEvacuated))
                 if notEvacuated == 0:
-                    t2 = self.getTimeFromICMMws (wsid)
-                    break;
+                    t2 = self.getSimulatedTime (wsid)
+
+            done = index + 1
+            self.saveFoldState (parents, index, self.foldState (t1, t2, properties))
+            if t2 != None:
+                break;
+        # no more OOI WorldStates needed after the end of the evacuation
+        worldstates.close ()
+        if done < len (parents):
+            self.saveFoldState (parents, len (parents) - 1, self.foldState (t1, t2, properties))
 
         self.status.set("Calculated 'Evacuation' indicator: Start Excercise: {0}, start evacuation: {1}, end evacuation {2}, end exercise (so far): {0}".format (
                 t0.isoformat(), 
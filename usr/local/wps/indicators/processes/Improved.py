@@ -53,6 +53,7 @@ import logging
 from crisma.Indicator import Indicator
 import crisma.ICMMtools as ICMM
 import crisma.OOItools as OOI
+import crisma.ThreadPool as ThreadPool
 
 class Process(Indicator):
     def __init__(self):
@@ -70,7 +71,8 @@ kpi;;Improved;Improved patients;Number of patients with actual health better or
 kpi;SeriouslyDeteriorated;Seriously deteriorated patients;Number of patients with (actual health) less than (health at the beginning - 50);number
 
 
-""")
+""",
+            requires = {'actual': [OOI.patientLifePropertyId], 'baseline': [OOI.patientExposedPropertyId, OOI.patientLifePropertyId]})
 
     def calculateIndicator(self):
         # Define values to be used if indicator can not be calculated (e.g. missing input data)
@@ -96,42 +98,21 @@ kpi;SeriouslyDeteriorated;Seriously deteriorated patients;Number of patients wit
          }
 
         self.status.set("Start collecting input data", 20)
-        # find base WorldState from ICMM
-        baseICMMworldstateId = ICMM.getBaseWorldstate (self.ICMMworldstate.id, baseCategory="Baseline", baseUrl=self.ICMMworldstate.endpoint)
-        if (baseICMMworldstateId is None):
-            raise Exception ("Base ICMM WorldState not found for actual ICMM WorldState = {0}".format (self.ICMMworldstate))
-
-        baseOOIworldstateURL = ICMM.getOOIRef (baseICMMworldstateId, 'OOI-worldstate-ref', baseUrl=self.ICMMworldstate.endpoint)
-        logging.info ("baseOOIworldstateURL = {0}".format (baseOOIworldstateURL))
-        if (baseOOIworldstateURL is None):
-            raise Exception ("invalid OOI URL: {0}".format (baseOOIworldstateURL))
-        
-        # OOI-URL -> Endpoint, id, ...
-        baseOOIworldstate = OOI.OOIAccess(baseOOIworldstateURL)
-        logging.info ("baseOOIWorldState = {0}".format (baseOOIworldstate))
-        if (baseOOIworldstate.endpoint is None):
-            raise Exception ("invalid OOI ref: {0}".format (baseOOIworldstate))
-
-        self.status.set("Base WorldState: {0}".format (baseOOIworldstateURL), 21)
+        # find base WorldState: ICMM -> OOI
+        baseOOIworldstate = self.getBaseOOIWorldstate ()
+
+        self.status.set("Base WorldState: {0}".format (baseOOIworldstate), 21)
 
         # now:
         #  self.OOIworldstate: Actual worldstate I want to calculate the indicator for
         #  baseOOIworldstate:  Worldstate at the beginning of the experiment / training
 
 
-        # find out which pationts are part of the game
-        IDsToSkip = []
-        logging.info("Request list of patient IDs to be taken into account from base OOI WorldState = {0}".format (baseOOIworldstate.id))
-        params = {
-            'wsid' :  baseOOIworldstate.id, 
-            'etpid' : OOI.patientExposedPropertyId
-            }
-        jsonBaseData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
-        for ep in jsonBaseData:
-            if ep["entityPropertyValue"].lower() == "false":
-                IDsToSkip.append (ep["entityId"])
-
-
+        # base and actual worldstate at the same time
+        actualProperties = ThreadPool.submit (OOI.prefetch, self.OOIworldstate.id, [OOI.patientLifePropertyId], baseUrl=self.OOIworldstate.endpoint)
+        # pationts part of the game and their life at the beginning: calculated once per exercise
+        logging.info("Request input data for base OOI WorldState = {0}".format (baseOOIworldstate.id))
+        baseline = OOI.getBaseline (baseOOIworldstate.id, baseUrl=self.OOIworldstate.endpoint, cached=self.isAncestor (baseOOIworldstate))
 
         # calculate indicator value
         # patients and their life state
@@ -139,57 +120,21 @@ kpi;SeriouslyDeteriorated;Seriously deteriorated patients;Number of patients wit
         numberOfDeteriorated = 0;
         totalCount = 0
 
-        # base data:
-        logging.info("Request input data for base OOI WorldState = {0}".format (baseOOIworldstate.id))
-        params = {
-            'wsid' :  baseOOIworldstate.id, 
-            'etpid' : OOI.patientLifePropertyId
-            }
-        jsonBaseData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
         # actual data:
-        params = {
-            'wsid' : self.OOIworldstate.id, 
-            'etpid' : OOI.patientLifePropertyId
-            }
-        jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
+        jsonData = actualProperties.result ()[OOI.patientLifePropertyId]
 
         self.status.set("Calculate indicator value", 30)
-        patients = {}
-
-        for ep in jsonBaseData:
-            if ep["entityId"] in IDsToSkip:
-                continue
-            # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
-            if ep["entityTypeProperty"]['entityTypePropertyType'] != 1: 
-                # print >> stderr, "Patient life property is not of type 1 (integer)!"
-                continue 
-            # The entityTypePropertyType might be a lie
-            try:
-                life = float (ep["entityPropertyValue"].replace (",", "."))
-                patients[ep["entityId"]] = life
-            except:
-                # print >> stderr, ep["entityPropertyValue"], " is not an integer!"
-                # ignore problem !?!?
-                pass
-        for ep in jsonData:
-            if ep["entityId"] in IDsToSkip:
-                continue
-            totalCount += 1
-            # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
-            if ep["entityTypeProperty"]['entityTypePropertyType'] != 1: 
-                # print >> stderr, "Patient life property is not of type 1 (integer)!"
-                continue 
-            # The entityTypePropertyType might be a lie
-            try:
-                life = float (ep["entityPropertyValue"].replace (",", "."))
-                if life >= patients[ep["entityId"]]:
-                    numberOfImproved += 1
-                if life < patients[ep["entityId"]] - 50:
-                    numberOfDeteriorated += 1
-            except:
-                # print >> stderr, ep["entityPropertyValue"], " is not an integer!"
-                # ignore problem !?!?
-                pass
+        # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
+        # The entityTypePropertyType might be a lie: only numbers are used
+        baseTable = baseline.life
+        patients = baseTable.byEntity ()
+        table = OOI.PropertyTable (jsonData)
+        table = table.select (baseline.participants (table))
+        totalCount = len (table)
+        table = table.select ((table.types == 1) & table.valid)
+        (baseLife, found) = table.lookup (baseTable)
+        numberOfImproved = int ((found & (table.numbers >= baseLife)).sum ())
+        numberOfDeteriorated = int ((found & (table.numbers < baseLife - 50)).sum ())
 
         self.status.set("Calculated improvedIndicator for ICMM WorldState with id {0}: {1} out of {2}".format (self.ICMMworldstate.id, numberOfImproved, len (patients)), 90)
 
@@ -53,6 +53,7 @@ import logging
 from crisma.Indicator import Indicator
 import crisma.ICMMtools as ICMM
 import crisma.OOItools as OOI
+import crisma.ThreadPool as ThreadPool
 
 class Process(Indicator):
     def __init__(self):
@@ -66,7 +67,8 @@ class Process(Indicator):
 
 indicator;PatientHealth;Patients health status summary;Number of patients with health categorized in 3 groups (up to 30, up to 70, better than 70);histogram
 
-""")
+""",
+            requires = {'actual': [OOI.patientLifePropertyId], 'baseline': [OOI.patientExposedPropertyId]})
 
     def calculateIndicator(self):
         # Define values to be used if indicator can not be calculated (e.g. missing input data)
@@ -74,53 +76,35 @@ indicator;PatientHealth;Patients health status summary;Number of patients with h
         # calculate indicator value
         self.status.set("Start collecting input data", 20)
 
-        # find out which pationts are part of the game
-        IDsToSkip = []
-        logging.info("Request list of patient IDs to be taken into account from base OOI WorldState = {0}".format (self.OOIworldstate.id))
-        params = {
-            'wsid' :  self.OOIworldstate.id, 
-            'etpid' : OOI.patientExposedPropertyId
-            }
-        jsonBaseData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
-        for ep in jsonBaseData:
-            if ep["entityPropertyValue"].lower() == "false":
-                IDsToSkip.append (ep["entityId"])
+        # actual data and the pationts part of the game (from the Baseline of the exercise) at the same time
+        properties = ThreadPool.submit (OOI.prefetch, self.OOIworldstate.id, [OOI.patientLifePropertyId], baseUrl=self.OOIworldstate.endpoint)
+        baseline = self.getBaseline ()
 
 
         # patients and their life state
         numberOfPatients = {'sum' : 0, 'green' : 0, 'yellow': 0, 'red' : 0}
         requiredLifePropertyValue = {'green': 70, 'yellow': 30} # below yellow: 'red'
 
-        params = {
-            'wsid' : self.OOIworldstate.id, 
-            'etpid' : OOI.patientLifePropertyId
-            }
-        jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
+        jsonData = properties.result ()[OOI.patientLifePropertyId]
 
         self.status.set("Got input data data", 21)
         self.status.set("Calculate indicator value", 30)
 
-        for ep in jsonData:
-            if ep["entityId"] in IDsToSkip:
-                continue
-            # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
-            if ep["entityTypeProperty"]['entityTypePropertyType'] != 1: 
-                logging.error ("Patient life property is not of type 1 (integer)!")
-                continue 
-            # The entityTypePropertyType might be a lie
-            try:
-                life = float (ep["entityPropertyValue"].replace (",", "."))
-                numberOfPatients['sum'] += 1
-                if life > requiredLifePropertyValue['green']:
-                    numberOfPatients['green'] += 1
-                elif life > requiredLifePropertyValue['yellow']:
-                    numberOfPatients['yellow'] += 1
-                else:
-                    numberOfPatients['red'] += 1
-            except:
-                logging.error (ep["entityPropertyValue"], " is not an integer!")
-                # ignore problem !?!?
-                pass
+        table = OOI.PropertyTable (jsonData)
+        table = table.select (baseline.participants (table))
+        # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
+        wrongType = table.types != 1
+        if wrongType.sum () > 0:
+            logging.error ("{0} patient life properties are not of type 1 (integer)!".format (wrongType.sum ()))
+        # The entityTypePropertyType might be a lie
+        notNumber = ~wrongType & ~table.valid
+        if notNumber.sum () > 0:
+            logging.error ("{0} patient life properties are not an integer!".format (notNumber.sum ()))
+        life = table.select (~wrongType & table.valid).numbers
+        numberOfPatients['sum'] = len (life)
+        numberOfPatients['green'] = int ((life > requiredLifePropertyValue['green']).sum ())
+        numberOfPatients['yellow'] = int (((life > requiredLifePropertyValue['yellow']) & (life <= requiredLifePropertyValue['green'])).sum ())
+        numberOfPatients['red'] = numberOfPatients['sum'] - numberOfPatients['green'] - numberOfPatients['yellow']
         
         self.status.set("Calculated PatientHealth: {0}".format (numberOfPatients), 40)
         
@@ -67,7 +67,8 @@ class Process(Indicator):
 indicator;ResourceDepleted;Number of depleted resources;Number of vehicles with response capacity 20% or lower;number
 kpi;ResourceDepleted;Number of depleted resources;Number of vehicles with response capacity 20% or lower;number
 
-""")
+""",
+            requires = {'actual': [OOI.vehicleCapacityPropertyId]})
 
 
     def calculateIndicator(self):
@@ -96,31 +97,24 @@ kpi;ResourceDepleted;Number of depleted resources;Number of vehicles with respon
         number = 0;
         requiredValue = 20;
 
-        params = {
-            'wsid' : self.OOIworldstate.id, 
-            'etpid' : OOI.vehicleCapacityPropertyId
-            }
-        jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
+        jsonData = OOI.getEntityProperties (self.OOIworldstate.id, OOI.vehicleCapacityPropertyId, baseUrl=self.OOIworldstate.endpoint)
 
         self.status.set("Got input data data", 21)
         logging.info ("worldstate data: {0}".format (json.dumps (jsonData)))
         self.status.set("Calculate indicator value", 30)
 
-        for ep in jsonData:
-            totalCount += 1
-            # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
-            if ep["entityTypeProperty"]['entityTypePropertyType'] != 1: 
-                logging.error ("Property is not of type 1 (integer)!")
-                continue 
-            # The entityTypePropertyType might be a lie
-            try:
-                life = float (ep["entityPropertyValue"].replace (",", "."))
-                if life <= requiredValue:
-                    number += 1;
-            except:
-                logging.error ("Property is not a number: '{0}'".format (ep["entityPropertyValue"]))
-                # ignore problem !?!?
-                pass
+        table = OOI.PropertyTable (jsonData)
+        totalCount = len (table)
+        # Needs to be int (0..100). If not this is an error. Just silently skip to get an result anyway!
+        wrongType = table.types != 1
+        if wrongType.sum () > 0:
+            logging.error ("{0} properties are not of type 1 (integer)!".format (wrongType.sum ()))
+        # The entityTypePropertyType might be a lie
+        notNumber = ~wrongType & ~table.valid
+        if notNumber.sum () > 0:
+            logging.error ("Property is not a number: {0}".format (list (table.select (notNumber).values)))
+        capacity = table.select (~wrongType & table.valid).numbers
+        number = int ((capacity <= requiredValue).sum ())
         
         self.status.set("Calculated number: {0} out of totalCount: {1}".format (number, totalCount), 40)
         
@@ -70,7 +70,8 @@ class Process(Indicator):
 indicator;UnusedResources;Number of resources not used;Number of available resources that was not used yet;number
 kpi;UnusedResources;Number of resources not used;Number of available resources that was not used yet;number
 
-""")
+""",
+            requires = {'chain': [OOI.vehicleAvailabilityPropertyId, OOI.vehicleDisplayStatePropertyId]})
 
     def calculateIndicator(self):
         # Define values to be used if indicator can not be calculated (e.g. missing input data)
@@ -91,34 +92,27 @@ kpi;UnusedResources;Number of resources not used;Number of available resources t
 
         self.status.set("Start collecting input data", 20)
         # find base WorldState from ICMM
-        parents = ICMM.getParentWorldstates (self.ICMMworldstate.id, baseCategory="Baseline", baseUrl=self.ICMMworldstate.endpoint)
+        parents = self.getParents ()
         if (parents is None):
             raise Exception ("Base ICMM WorldState not found for actual ICMM WorldState = {0}".format (self.ICMMworldstate))
 
         # resources: id -> [unavailable | unused | used]
         resources = {}
 
-
-        for wsid in parents:
-            logging.info ("get ws {0}".format (wsid))
-            ooiWorldstateURL = ICMM.getOOIRef (wsid, 'OOI-worldstate-ref', baseUrl=self.ICMMworldstate.endpoint)
-            logging.info ("  ooiWorldstateURL = {0}".format (ooiWorldstateURL))
-            if (ooiWorldstateURL is None):
-                return "invalid OOI URL: {0}".format (ooiWorldstateURL)
-            # OOI-URL -> Endpoint, id, ...
-            ooiWorldstate = OOI.OOIAccess(ooiWorldstateURL)
-            # logging.info ("ooiWorldState = {0}".format (ooiWorldstate))
-            if (ooiWorldstate.endpoint is None):
-                return "invalid OOI ref: {0}".format (ooiWorldstate)
-        
-
-            logging.info("Request input data for OOI WorldState = {0}".format (ooiWorldstate.id))
-            params = {
-                'wsid' :  ooiWorldstate.id 
-                }
-            jsonData = OOI.getJson ("{0}/EntityProperty".format (self.OOIworldstate.endpoint), params=params) 
-
-            # this now contaions ALL EntityPropertyIds !
+        # continue with the resources of the nearest parent worldstate already evaluated
+        (done, state) = self.loadFoldState (parents)
+        if state is not None:
+            resources = dict (state)
+
+        # all OOI WorldStates are loaded in parallel, evaluated in order
+        # only the changes against the previous worldstate are needed: unchanged properties were evaluated before
+        needed = [OOI.vehicleAvailabilityPropertyId, OOI.vehicleDisplayStatePropertyId]
+        worldstates = self.iterOOIWorldstates (parents[done:], needed, parents[done - 1] if done > 0 else None)
+        # removed properties do not matter: a resource stays counted as it was seen last
+        for (index, (wsid, ooiWorldstate, jsonData, removed)) in enumerate (worldstates, done):
+            if (ooiWorldstate is None):
+                worldstates.close ()
+                return jsonData
 
             for ep in jsonData:
                 if (OOI.vehicleAvailabilityPropertyId == ep["entityTypePropertyId"]):
@@ -130,7 +124,7 @@ kpi;UnusedResources;Number of resources not used;Number of available resources t
                             else:
                                 resources[ep["entityId"]] = "unused"
                         except Exception, e:
-                            logging.error ("problem {1} with EntityProperty {0}".format (json.dumps (ep), e))
+                            logging.error ("problem {1} with EntityProperty {0}".format (json.dumps (ep.asDict ()), e))
                     continue
 
                 if (OOI.vehicleDisplayStatePropertyId == ep["entityTypePropertyId"]):
@@ -142,6 +136,8 @@ kpi;UnusedResources;Number of resources not used;Number of available resources t
                     continue
 
             logging.info ("Resources so far: {0}".format (len (resources)))
+            # json: list of (id, state), ids are numbers
+            self.saveFoldState (parents, index, resources.items ())
 
         noUnavailable = 0
         noUnused = 0
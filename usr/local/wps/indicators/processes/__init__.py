@@ -1,3 +1,3 @@
-__all__=['PatientHealth', 'Deaths', 'Improved', 'ResourceDepleted', 'EffectiveResponse', 'Evacuation', 'UnusedResources']
+__all__=['PatientHealth', 'Deaths', 'Improved', 'ResourceDepleted', 'EffectiveResponse', 'Evacuation', 'UnusedResources', 'AllIndicators']
 
 # also update /usr/lib/cgi-bin/OrionListener.py !!
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+#
+# Shared HTTP client for ICMM and OOI access
+#
+# All upstream calls go through one requests session per process. The session
+# keeps a connection pool per host, so consecutive calls to the same ICMM or
+# OOI-WSR reuse an already open (keep-alive) connection instead of doing a new
+# TCP/TLS handshake each time.
+
+######################
+#  Configuration
+poolConnections = 10      # number of per-host connection pools to keep
+poolMaxsize = 10          # number of keep-alive connections per host
+timeout = 60              # seconds to wait for connect / response
+retries = 2               # additional attempts for failed idempotent requests
+retryBackoff = 0.5        # seconds; doubled for each further attempt
+retryStatus = [502, 503, 504]
+executionBudget = 240     # seconds for all upstream calls of one indicator execution, see Deadline
+chunkSize = 16384         # bytes read at once from streamed responses
+cacheBytes = 64 * 1024 * 1024  # disk space for cached ICMM responses (LocalStore, see ConditionalCache)
+#####################
+
+import requests
+import threading
+import urllib
+import json
+import time
+import logging
+import urlparse
+
+import LocalStore
+
+idempotentMethods = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+
+_session = None
+_sessionLock = threading.Lock ()
+_deadline = None
+
+
+def _createSession ():
+    session = requests.Session ()
+    # Depending on the requests-version pool settings are done with an adapter or in the session config
+    try:
+        from requests.adapters import HTTPAdapter
+        for prefix in ['http://', 'https://']:
+            session.mount (prefix, HTTPAdapter (pool_connections=poolConnections, pool_maxsize=poolMaxsize))
+    except ImportError:
+        session.config['pool_connections'] = poolConnections
+        session.config['pool_maxsize'] = poolMaxsize
+        session.config['keep_alive'] = True
+    return session
+
+
+def getSession ():
+    """Get the (process wide) session holding the connection pools"""
+    global _session
+    if _session is None:
+        with _sessionLock:
+            if _session is None:
+                _session = _createSession ()
+    return _session
+
+
+def configure (**settings):
+    """Change configuration values, e.g. configure (poolMaxsize=20, timeout=30)
+
+    An existing session is dropped so the new pool sizes are used for the next request.
+    """
+    global _session
+    for key in settings:
+        if key not in ['poolConnections', 'poolMaxsize', 'timeout', 'retries', 'retryBackoff', 'retryStatus', 'executionBudget']:
+            raise Exception ("Unknown HTTP configuration value: {0}".format (key))
+        globals()[key] = settings[key]
+    with _sessionLock:
+        _session = None
+
+
+class Counters:
+    """Upstream calls, bytes received and records read per service, for the timings of an execution
+
+    pywps runs one execution per process, so the counters are process wide.
+    The service of an URL is the name given to its prefix (see setService) or its host.
+    """
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.services = []      # [(URL prefix, name)], longest prefix first
+        self.values = {}        # service -> {counter: value}
+
+    def reset (self):
+        """Start counting again"""
+        with self.lock:
+            self.services = []
+            self.values = {}
+
+    def setService (self, prefix, name):
+        """Count the calls to URLs starting with prefix as service name, e.g. setService (ICMM endpoint, 'ICMM')"""
+        with self.lock:
+            self.services = sorted ([(p, n) for (p, n) in self.services if p != prefix] + [(prefix, name)], key=lambda (p, n): -len (p))
+
+    def serviceOf (self, url):
+        for (prefix, name) in self.services:
+            if url.startswith (prefix):
+                return name
+        return urlparse.urlparse (url).netloc
+
+    def add (self, url, counter, value=1):
+        service = self.serviceOf (url)
+        with self.lock:
+            values = self.values.setdefault (service, {})
+            values[counter] = values.get (counter, 0) + value
+
+    def get (self):
+        with self.lock:
+            return dict ((service, dict (values)) for (service, values) in self.values.items ())
+
+counters = Counters ()
+
+
+def _countStream (response, url):
+    """Count the bytes of a streamed response while they are read"""
+    iterContent = response.iter_content
+    def countedIterContent (*args, **kwargs):
+        for chunk in iterContent (*args, **kwargs):
+            counters.add (url, 'bytes', len (chunk))
+            yield chunk
+    response.iter_content = countedIterContent
+
+
+class DeadlineExceeded (Exception):
+    """The time budget of the actual execution is used up"""
+    pass
+
+
+class Deadline:
+    """Point in time all upstream calls of an execution have to be finished"""
+    def __init__ (self, budget):
+        self.budget = budget
+        self.end = time.time () + budget
+
+    def __repr__ (self):
+        return "Deadline {0}s, {1:.1f}s left".format (self.budget, self.remaining ())
+
+    def remaining (self):
+        return self.end - time.time ()
+
+
+def setDeadline (budget=None):
+    """Start a deadline of budget seconds for all following requests of this process
+
+    budget=None: no deadline, just the timeout per request
+
+    pywps runs one execution per process, so the deadline is process wide
+    (and also valid in threads started by the execution).
+
+    returns the Deadline or None
+    """
+    global _deadline
+    _deadline = Deadline (budget) if budget is not None else None
+    return _deadline
+
+
+def remaining ():
+    """Seconds left until the deadline or None if there is no deadline
+
+    raises DeadlineExceeded if the deadline is over
+    """
+    if _deadline is None:
+        return None
+    left = _deadline.remaining ()
+    if left <= 0:
+        raise DeadlineExceeded ("no time left from the budget of {0}s".format (_deadline.budget))
+    return left
+
+
+def request (method, url, **kwargs):
+    """Send a request using the pooled session
+
+    Idempotent requests are retried on connection problems and on
+    the status codes listed in retryStatus.
+    The timeout of each request is limited to the time left until the deadline.
+
+    returns the requests response
+    raises DeadlineExceeded if there is no time left
+    """
+    method = method.upper ()
+    streamed = (kwargs.get ('stream') == True) or (kwargs.get ('prefetch') == False)
+    requestTimeout = kwargs.pop ('timeout', timeout)
+    attempts = 1 + (retries if method in idempotentMethods else 0)
+    delay = retryBackoff
+    attempt = 0
+    while True:
+        attempt += 1
+        left = remaining ()
+        kwargs['timeout'] = requestTimeout if left is None else min (requestTimeout, left)
+        try:
+            counters.add (url, 'calls')
+            response = getSession ().request (method, url, **kwargs)
+            if streamed:
+                _countStream (response, url)
+            else:
+                counters.add (url, 'bytes', len (response.content or ''))
+            if (response.status_code not in retryStatus) or (attempt >= attempts):
+                return response
+            logging.warning ("{0} {1}: status {2}, retry {3}/{4}".format (method, url, response.status_code, attempt, attempts - 1))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+            if (_deadline is not None) and (_deadline.remaining () <= 0):
+                raise DeadlineExceeded ("{0} {1}: no time left from the budget of {2}s".format (method, url, _deadline.budget))
+            if attempt >= attempts:
+                raise
+            logging.warning ("{0} {1}: {2}, retry {3}/{4}".format (method, url, e, attempt, attempts - 1))
+        left = remaining ()
+        if (left is not None) and (left <= delay):
+            raise DeadlineExceeded ("{0} {1}: no time left for retry from the budget of {2}s".format (method, url, _deadline.budget))
+        time.sleep (delay)
+        delay = delay * 2
+
+
+def get (url, **kwargs):
+    return request ('GET', url, **kwargs)
+
+def put (url, **kwargs):
+    return request ('PUT', url, **kwargs)
+
+def post (url, **kwargs):
+    return request ('POST', url, **kwargs)
+
+def delete (url, **kwargs):
+    return request ('DELETE', url, **kwargs)
+
+def getStream (url, **kwargs):
+    """GET without reading the body, read it with response.iter_content (chunkSize)"""
+    if requests.__version__.split ('.')[0] == '0':
+        kwargs['prefetch'] = False
+    else:
+        kwargs['stream'] = True
+    return request ('GET', url, **kwargs)
+
+
+class CachedResponse:
+    """Response (just what is used by ICMMtools / OOItools) served from the ConditionalCache"""
+    def __init__ (self, url, text):
+        self.url = url
+        self.status_code = 200
+        self.text = text
+        self.fromCache = True
+
+    def json (self):
+        return json.loads (self.text)
+
+
+class ConditionalCache:
+    """Cache for GET requests kept in the LocalStore
+
+    Bodies are stored by URL and parameters. If the server sent an ETag or
+    Last-Modified header, the cached body is revalidated with
+    If-None-Match / If-Modified-Since, so only a "304 Not Modified" is transferred.
+    Without these headers a body is used without asking the server for ttl seconds.
+    The least recently used entries are removed above cacheBytes.
+    """
+    namespace = 'HTTP-cache'
+
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.hits = 0           # served from the cache, no request
+        self.revalidated = 0    # served from the cache after "304 Not Modified"
+        self.misses = 0         # full response transferred
+        self.bytesSaved = 0
+
+    def count (self, counter, saved=0):
+        with self.lock:
+            setattr (self, counter, getattr (self, counter) + 1)
+            self.bytesSaved += saved
+
+    def stats (self):
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'bytesSaved': self.bytesSaved
+            }
+
+    def key (self, url, params):
+        if not params:
+            return url
+        return "{0}?{1}".format (url, urllib.urlencode (sorted ((k, v) for (k, v) in params.items () if v is not None))) 
+
+    def lookup (self, key, ttl, headers):
+        """Get the cache entry for key
+
+        returns (entry, fresh): fresh if it can be used without asking the server,
+        otherwise the validators of the entry are added to headers
+        """
+        entry = LocalStore.getStore ().get (self.namespace, key, touch=True)
+        if entry is None:
+            return (None, False)
+        if entry.get ('etag') or entry.get ('lastModified'):
+            if entry.get ('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get ('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+            return (entry, False)
+        return (entry, entry['time'] + ttl > time.time ())
+
+    def store (self, key, response, ttl, entry):
+        etag = response.headers.get ('ETag')
+        lastModified = response.headers.get ('Last-Modified')
+        if etag or lastModified or (ttl > 0):
+            entry['time'] = time.time ()
+            entry['etag'] = etag
+            entry['lastModified'] = lastModified
+            store = LocalStore.getStore ()
+            store.put (self.namespace, key, entry)
+            store.evict (self.namespace, cacheBytes)
+
+    def get (self, url, params=None, ttl=0, **kwargs):
+        """GET url, using the cache where possible
+
+        ttl: seconds a body without ETag / Last-Modified may be used without asking the server
+        """
+        key = self.key (url, params)
+        headers = dict (kwargs.pop ('headers', None) or {})
+        (entry, fresh) = self.lookup (key, ttl, headers)
+        if fresh:
+            self.count ('hits', len (entry['body']))
+            return CachedResponse (key, entry['body'])
+        response = get (url, params=params, headers=headers, **kwargs)
+        if (response.status_code == 304) and (entry is not None):
+            self.count ('revalidated', len (entry['body']))
+            return CachedResponse (response.url, entry['body'])
+        self.count ('misses')
+        if response.status_code == 200:
+            self.store (key, response, ttl, {'body': response.text})
+        return response
+
+    def getValue (self, url, extract, params=None, ttl=0, variant='', **kwargs):
+        """Like get, but the value extract (response) is cached instead of the body
+
+        The response is streamed, so extract can read just the needed part of it
+        with response.iter_content (chunkSize).
+        variant: distinguishes values extracted differently from the same URL
+
+        returns the extracted value
+        raises Exception if the status is not 200
+        """
+        key = "{0}#{1}".format (self.key (url, params), variant)
+        headers = dict (kwargs.pop ('headers', None) or {})
+        (entry, fresh) = self.lookup (key, ttl, headers)
+        if fresh:
+            self.count ('hits')
+            return entry['value']
+        response = getStream (url, params=params, headers=headers, **kwargs)
+        try:
+            if (response.status_code == 304) and (entry is not None):
+                self.count ('revalidated')
+                return entry['value']
+            self.count ('misses')
+            if response.status_code != 200:
+                raise Exception ("Error accessing {0}: {1}".format (response.url, response.status_code))
+            value = extract (response)
+            self.store (key, response, ttl, {'value': value})
+            return value
+        finally:
+            if hasattr (response, 'close'):   # not in old requests versions
+                response.close ()
+
+cache = ConditionalCache ()
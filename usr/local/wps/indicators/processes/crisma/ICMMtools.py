@@ -9,17 +9,30 @@
 #  Configuration
 defaultBaseUrl = 'http://crisma.cismet.de/pilotC/icmm_api'
 defaultDomain = 'CRISMA'
+idBlockSize = 50          # number of ids reserved at once
+idBlockTtl = 300          # seconds a reserved block of ids may be used
+idTailSize = 100          # collection entries read to find the highest id if ICMM has no /nextId
+constantsTtl = 24 * 3600  # seconds until the ICMM constants are refreshed
+metadataCacheTtl = 3600   # seconds to use cached worldstate metadata (name, parents, OOI-ref) if ICMM does not support revalidation
+kpiWriteAttempts = 3      # merges of kpi values into iccdata if ICMM answered with a gateway error
+kpiFlushLease = 30        # seconds a KpiWriter may write the spooled kpi values before another one takes over
+kpiWaitInterval = 0.1     # seconds between checks if spooled kpi values are written
+kpiSpoolBytes = 4 * 1024 * 1024  # disk space for the kpi spools of the worldstates (LocalStore)
 #####################
 
 import json
-import requests
+import HTTPtools as HTTP
 import re
-#import time
+import time
+import threading
 import string
 import datetime
 import math
 import logging
 
+import LocalStore
+import JSONstream
+
 # Some ICMM "constants" that are used in pilotC and pilotE
 
 # categories/3: OOI-indicator-ref (pointing to OOI-WSR)
@@ -34,6 +47,15 @@ datadescriptorIdIndicatorValue = 3
 # datadescriptors/4: ICC data vector
 datadescriptorIdICCdata = 4
 
+# These are the defaults only, the actual values of an ICMM are given by constants (baseUrl, domain)
+defaultConstants = {
+    'categoryIdIndicatorRef': categoryIdIndicatorRef,
+    'categoryIdIndicatorValue': categoryIdIndicatorValue,
+    'datadescriptorIdOOIRef': datadescriptorIdOOIRef,
+    'datadescriptorIdIndicatorValue': datadescriptorIdIndicatorValue,
+    'datadescriptorIdICCdata': datadescriptorIdICCdata
+    }
+
 class ICMMAccess:
     def __init__ (self, url):
         """crunch ICMM URL into endpoint, domain, clazz, id
@@ -64,68 +86,171 @@ class ICMMAccess:
 
 
 def getConstants (baseUrl=defaultBaseUrl, domain=defaultDomain):
-    """Get id values for some clasifications and datadescriptors
+    """Get id values for some clasifications and datadescriptors from ICMM
+
+    Values not found in ICMM are taken from the defaults above.
 
+    returns: {'categoryIdIndicatorRef': 3, 'categoryIdIndicatorValue': 4, 'datadescriptorIdOOIRef': 1, ...}
     """
+    result = dict (defaultConstants)
+    headers = {'content-type': 'application/json'}
     params = {
         'limit' :  999999999,
         'level' : 1,
-        'fields' : 'id,key',
-        'class' : 'categories'
+        'fields' : 'id,key'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}".format (baseUrl, domain, clazz), params=params, headers=headers, verify=False) 
+    response = HTTP.get ("{0}/{1}.{2}".format (baseUrl, domain, "categories"), params=params, headers=headers, verify=False) 
     if response.status_code != 200:
-        raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.raise_for_status()))
+        raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
     # Depending on the requests-version json might be an field instead of on method
     jsonData = response.json() if callable (response.json) else response.json
     collection = jsonData['$collection']
     for r in collection:
-        if r['key'] == 'OOI-indicator-ref':
-            categoryIdIndicatorRef = r['id']
-        elif r['key'] == 'indicator-value':
-            categoryIdIndicatorValue = r['id']
+        if r.get ('key') == 'OOI-indicator-ref':
+            result['categoryIdIndicatorRef'] = r['id']
+        elif r.get ('key') == 'indicator-value':
+            result['categoryIdIndicatorValue'] = r['id']
     params = {
         'limit' :  999999999,
         'level' : 1,
-        'fields' : 'id,name',
-        'class' : 'datadescriptors'
+        'fields' : 'id,name'
         }
-    response = requests.get("{0}/{1}.{2}".format (baseUrl, domain, clazz), params=params, headers=headers, verify=False) 
+    response = HTTP.get ("{0}/{1}.{2}".format (baseUrl, domain, "datadescriptors"), params=params, headers=headers, verify=False) 
     if response.status_code != 200:
-        raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.raise_for_status()))
+        raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
     # Depending on the requests-version json might be an field instead of on method
     jsonData = response.json() if callable (response.json) else response.json
     collection = jsonData['$collection']
     for r in collection:
-        if r['key'] == 'OOI-WSR':
-            datadescriptorIdOOIRef = r['id']
-        elif r['key'] == 'indicator value':
-            datadescriptorIdIndicatorValue = r['id']
-        elif r['key'] == 'ICC Data Vector descriptor':
-            datadescriptorIdICCdata = r['id']
+        if r.get ('name') == 'OOI-WSR':
+            result['datadescriptorIdOOIRef'] = r['id']
+        elif r.get ('name') == 'indicator value':
+            result['datadescriptorIdIndicatorValue'] = r['id']
+        elif r.get ('name') == 'ICC Data Vector descriptor':
+            result['datadescriptorIdICCdata'] = r['id']
+    return result
+
 
+class ConstantsCache:
+    """getConstants per ICMM endpoint, without asking ICMM on the request path
+
+    Values are kept in the LocalStore and loaded from there when the process starts.
+    Only an endpoint never seen before on this host is asked directly.
+    Values older than constantsTtl are still used, but refreshed in the background.
+    """
+    namespace = 'ICMM-constants'
+
+    def __init__ (self):
+        self.constants = {}     # "endpoint/domain" -> {'time': ..., 'constants': {...}}
+        self.refreshing = set ()
+        self.lock = threading.Lock ()
+
+    def preload (self):
+        """Load all known constants from the LocalStore"""
+        for (key, entry) in LocalStore.getStore ().items (self.namespace):
+            self.constants[key] = entry
+
+    def get (self, baseUrl=defaultBaseUrl, domain=defaultDomain):
+        key = "{0}/{1}".format (baseUrl, domain)
+        entry = self.constants.get (key)
+        if entry is None:
+            entry = LocalStore.getStore ().get (self.namespace, key)
+            if entry is None:
+                try:
+                    entry = self.load (key, baseUrl, domain)
+                except HTTP.DeadlineExceeded:
+                    raise
+                except Exception, e:
+                    # use the defaults for now, they are outdated so the next call tries again in the background
+                    logging.warning ("Using default ICMM constants for {0}: {1}".format (key, e))
+                    entry = {'time': 0, 'constants': defaultConstants}
+            self.constants[key] = entry
+        if entry['time'] + constantsTtl < time.time ():
+            self.refresh (key, baseUrl, domain)
+        return entry['constants']
+
+    def load (self, key, baseUrl, domain):
+        entry = {
+            'time': time.time (),
+            'constants': getConstants (baseUrl, domain)
+            }
+        LocalStore.getStore ().put (self.namespace, key, entry)
+        self.constants[key] = entry
+        logging.info ("ICMM constants for {0}: {1}".format (key, entry['constants']))
+        return entry
+
+    def refresh (self, key, baseUrl, domain):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add (key)
+        def run ():
+            try:
+                self.load (key, baseUrl, domain)
+            except Exception, e:
+                logging.warning ("Refreshing ICMM constants for {0} failed: {1}".format (key, e))
+            finally:
+                with self.lock:
+                    self.refreshing.discard (key)
+        thread = threading.Thread (target=run, name="ICMM-constants")
+        thread.daemon = True
+        thread.start ()
+
+constantsCache = ConstantsCache ()
+constantsCache.preload ()
+
+
+def constants (baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """ICMM constants (see getConstants) for the given endpoint"""
+    return constantsCache.get (baseUrl, domain)
+
+
+idScanNamespace = 'ICMM-id-scans'
 
 def getIdOld (clazz, baseUrl=defaultBaseUrl, domain=defaultDomain):
     """Get the next available id for the given class
 
+    For ICMM without /nextId. The entries are not sorted by id, but new ones are
+    appended to the collection: the highest id and the size of the collection are
+    kept in the LocalStore, later just the tail with the entries added since then is read.
+    All entries (just their ids) are read the first time and if more than
+    idTailSize entries were added meanwhile.
+
     clazz: class name within ICMM
     """
+    headers = {'content-type': 'application/json'}
+    url = "{0}/{1}.{2}".format (baseUrl, domain, clazz)
+    store = LocalStore.getStore ()
+    scanned = store.get (idScanNamespace, url)
     params = {
         'limit' :  999999999,
         'level': 1,
-        'fields': None
+        'fields': 'id'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}".format (baseUrl, domain, clazz), params=params, headers=headers, verify=False) 
-    # this was the request:
-    #print response.url
+    size = None
+    if scanned is not None:
+        # Just one entry, but this tells where the last page starts
+        params['limit'] = 1
+        response = HTTP.get (url, params=params, headers=headers, verify=False) 
+        if response.status_code != 200:
+            raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
+        jsonData = response.json() if callable (response.json) else response.json
+        match = re.search ("offset=([0-9]+)", jsonData.get ('$last') or "")
+        if match:
+            size = int (match.group(1)) + 1
+        if (size is not None) and (size - scanned['size'] <= idTailSize):
+            params['limit'] = idTailSize
+            params['offset'] = max (0, size - idTailSize)
+        else:
+            logging.info ("{0}: read all entries to find the next id".format (url))
+            scanned = None
+            params['limit'] = 999999999
+    response = HTTP.get (url, params=params, headers=headers, verify=False) 
     if response.status_code != 200:
         raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
     # Depending on the requests-version json might be an field instead of on method
-    # print response.json()
     jsonData = response.json() if callable (response.json) else response.json
-    maxid = 0;
+    maxid = 0 if scanned is None else scanned['maxid']
     collection = jsonData['$collection']
     for r in collection:
         ref = r['$self']
@@ -134,25 +259,31 @@ def getIdOld (clazz, baseUrl=defaultBaseUrl, domain=defaultDomain):
             id = int (match.group(1))
             if (id > maxid):
                 maxid = id
+    if size is None:
+        size = len (collection)
+    store.put (idScanNamespace, url, {'maxid': maxid, 'size': size})
     return maxid + 1
 
 
-def getId (clazz, baseUrl=defaultBaseUrl, domain=defaultDomain):
-    """Get the next available id for the given class
+def getNextId (clazz, baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Ask ICMM for the next available id for the given class
 
     clazz: class name within ICMM
     domain: NEED TO BE 'CRISMA'
     """
     if not "CRISMA" == domain:
         raise Exception ("Only allowed domain is 'CRISMA'")
+    if baseUrl in endpointsWithoutNextId:
+        return getIdOld (clazz, baseUrl, domain)
     params = {
         'domain': domain,
         'class': clazz
         }
     headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/nextId".format (baseUrl), params=params, headers=headers, verify=False) 
+    response = HTTP.get ("{0}/nextId".format (baseUrl), params=params, headers=headers, verify=False) 
     if response.status_code == 404:
         # ICMM without Peter's Patch?
+        endpointsWithoutNextId.add (baseUrl)
         return getIdOld (clazz, baseUrl, domain)
     if response.status_code != 200:
         raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
@@ -161,21 +292,97 @@ def getId (clazz, baseUrl=defaultBaseUrl, domain=defaultDomain):
     # print jsonData
     return jsonData['nextId']
 
+endpointsWithoutNextId = set ()
 
-def getNameDescription (wsid, baseUrl=defaultBaseUrl, domain=defaultDomain):
-    """Get name and description of worldstate id
-    
+
+class IdAllocator:
+    """Hand out ICMM ids from reserved blocks shared by all processes on this host
+
+    ICMM does not reserve ids, so a block starts at the next id known by ICMM
+    or after the high-water mark of all blocks reserved so far, whatever is higher.
+    The actual block and the high-water mark per (endpoint, class) are kept in the
+    LocalStore: all processes take their ids from the same block, only a new block
+    asks ICMM (/nextId). A block is only used for idBlockTtl seconds: ids created
+    meanwhile by other ICMM clients would not be seen.
+    """
+    namespace = 'ICMM-ids'
+
+    def __init__ (self):
+        self.blocks = {}        # (endpoint, domain, clazz) -> {'next', 'end', 'time'}, if the LocalStore is not usable
+        self.lock = threading.Lock ()
+
+    def take (self, block, count, serverNextId=None):
+        """Block after taking count ids: 'taken' is the first of them, None if serverNextId is needed for a new block"""
+        if not isinstance (block, dict):
+            # nothing reserved yet (or just a high-water mark)
+            block = {'next': block or 0, 'end': block or 0, 'time': 0}
+        block = dict (block)
+        if (block['end'] - block['next'] >= count) and (block['time'] + idBlockTtl >= time.time ()):
+            block['taken'] = block['next']
+        elif serverNextId is None:
+            block['taken'] = None
+            return block
+        else:
+            # new block after the high-water mark (end of the last block)
+            start = max (serverNextId, block['end'])
+            block = {'next': start, 'end': start + max (count, idBlockSize), 'time': time.time (), 'taken': start}
+            logging.info ("Reserved ids {0}..{1}".format (block['next'], block['end'] - 1))
+        block['next'] = block['taken'] + count
+        return block
+
+    def update (self, key, count, serverNextId=None):
+        (baseUrl, domain, clazz) = key
+        block = LocalStore.getStore ().update (self.namespace, "{0}/{1}.{2}".format (baseUrl, domain, clazz),
+                                               lambda block: self.take (block, count, serverNextId))
+        if block is None:
+            # no local store, at least avoid duplicates within this process
+            with self.lock:
+                block = self.take (self.blocks.get (key), count, serverNextId)
+                self.blocks[key] = block
+        return block['taken']
+
+    def getIds (self, clazz, count=1, baseUrl=defaultBaseUrl, domain=defaultDomain):
+        """Get count unused ids for the given class"""
+        key = (baseUrl, domain, clazz)
+        first = self.update (key, count)
+        if first is None:
+            first = self.update (key, count, getNextId (clazz, baseUrl=baseUrl, domain=domain))
+        return range (first, first + count)
+
+idAllocator = IdAllocator ()
+
+
+def getIds (clazz, count, baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get count unused ids for the given class
+
+    clazz: class name within ICMM
+    domain: NEED TO BE 'CRISMA'
+    """
+    return idAllocator.getIds (clazz, count, baseUrl=baseUrl, domain=domain)
+
+
+def getId (clazz, baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get the next available id for the given class
+
+    clazz: class name within ICMM
+    domain: NEED TO BE 'CRISMA'
+    """
+    return getIds (clazz, 1, baseUrl=baseUrl, domain=domain)[0]
+
+
+def getJson (url, params=None, cacheTtl=None):
+    """GET an ICMM object
+
+    cacheTtl: None: always read from ICMM
+              otherwise use HTTP.cache: revalidated if ICMM supports it, else used for cacheTtl seconds
+
+    returns: object as json structure
     """
-    # http://crisma.cismet.de/pilotC/icmm_api/CRISMA.worldstates/3?level=1&fields=name%2Cdescription&omitNullValues=true&deduplicate=true
-    # get (grand*)parent worldstate list
-    params = {
-        'level' :  1,
-        'fields' : "name,description",
-        'omitNullValues' : 'true',
-        'deduplicate' : 'true'
-        }
     headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
+    if cacheTtl is None:
+        response = HTTP.get (url, params=params, headers=headers, verify=False) 
+    else:
+        response = HTTP.cache.get (url, params=params, ttl=cacheTtl, headers=headers, verify=False) 
 
     if response.status_code != 200:
         raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
@@ -185,54 +392,111 @@ def getNameDescription (wsid, baseUrl=defaultBaseUrl, domain=defaultDomain):
         raise Exception ("No such ICMM WorldState")
 
     # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
-    return {
-        'ICMMname' : worldstate["name"],
-        'ICMMdescription' : worldstate["description"]
-        }
+    return response.json() if callable (response.json) else response.json
 
-def getBaseWorldstate (wsid, baseCategory="Baseline", baseUrl=defaultBaseUrl, domain=defaultDomain):
-    """Get parent worldstate id with given category or None
+def getWorldstate (wsid, params, baseUrl=defaultBaseUrl, domain=defaultDomain, cacheTtl=None):
+    """GET an ICMM worldstate
+
+    params: level, fields, ... as used by ICMM
+    cacheTtl: see getJson
+
+    returns: worldstate as json structure
+    """
+    return getJson ("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params, cacheTtl=cacheTtl)
+
+def refOf (o):
+    """Reference of an ICMM object, no matter if it is expanded ($self) or not ($ref)"""
+    if '$self' in o:
+        return o['$self']
+    return o['$ref']
+
+def findIndicatorDataitem (worldstate, name, baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get the dataitem holding the indicator value with the given name or None
+
+    worldstate: ICMM worldstate including worldstatedata (level >= 2)
+    """
+    if (worldstate.get ('worldstatedata') is not None):
+        indicatorValueRef = "/{0}.categories/{1}".format (domain, constants (baseUrl, domain)['categoryIdIndicatorValue'])
+        for d in worldstate['worldstatedata']:
+            if ('categories' in d) and (d.get ('name') == name):
+                for c in d['categories']:
+                    if refOf (c) == indicatorValueRef:
+                        return d
+    return None
+
+
+def getNameDescription (wsid, baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get name and description of worldstate id
     
-    default baseCategory: "Baseline". Other posibilities: "Template"
     """
-    # http://crisma.cismet.de/pilotC/icmm_api/CRISMA.worldstates/3?level=1000&fields=parentworldstate%2Ccategories&omitNullValues=true&deduplicate=true
+    # http://crisma.cismet.de/pilotC/icmm_api/CRISMA.worldstates/3?level=1&fields=name%2Cdescription&omitNullValues=true&deduplicate=true
     # get (grand*)parent worldstate list
     params = {
-        'level' :  1000,
-        'fields' : "parentworldstate,categories,key,id",
+        'level' :  1,
+        'fields' : "name,description",
         'omitNullValues' : 'true',
         'deduplicate' : 'true'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
+    worldstate = getWorldstate (wsid, params, baseUrl=baseUrl, domain=domain, cacheTtl=metadataCacheTtl)
+    return {
+        'ICMMname' : worldstate["name"],
+        'ICMMdescription' : worldstate["description"]
+        }
 
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
+def iterAncestry (events):
+    """Yield (id, [category keys]) for a worldstate and its (grand*)parents, current worldstate first
 
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
-    while (True):
-        if ('categories' in worldstate):
-            for c in worldstate['categories']:
-                if c['key'] == baseCategory:                
-                    return worldstate['id']
-        if ('parentworldstate' not in worldstate):
-            return None
-        worldstate =  worldstate['parentworldstate']
-    return None # never reach this, just to see the end of the function.
+    events: JSONstream.events of a worldstate with nested parentworldstate
+            (level=1000, fields "parentworldstate,categories,key,id")
 
-def getParentWorldstates (wsid, baseCategory="Baseline", baseUrl=defaultBaseUrl, domain=defaultDomain):
-    """Get parent worldstate ids uo and including the first with the given category or None
-    
-    default baseCategory: "Baseline". Other posibilities: "Template"
+    The values of a worldstate are yielded as soon as its id and categories are read,
+    so the caller can stop reading at the worldstate it is looking for.
+    Only the depth is tracked, so the work per event does not grow with the chain.
+    """
+    levels = []        # per worldstate depth: {'id', 'categories', 'done'}
+    keys = {}          # category $self -> key, to resolve deduplicated categories
+    containers = []    # keys of the open containers below the deepest open worldstate
+    depth = -1         # depth of the deepest open worldstate (0: the worldstate itself)
+    category = None
+    nextDepth = 0
+    for (event, key, value) in events:
+        if (event == 'start_map') and (len (containers) == 0) and ((depth == -1) or (key == 'parentworldstate')):
+            depth += 1
+            levels.append ({'id': None, 'categories': [], 'done': False})
+        elif (event == 'start_map') or (event == 'start_array'):
+            containers.append (key)
+            if (len (containers) == 2) and (containers[0] == 'categories'):
+                category = {}
+        elif (event == 'end_map') or (event == 'end_array'):
+            if len (containers) == 0:
+                levels[depth]['done'] = True
+                depth -= 1
+            else:
+                if (len (containers) == 2) and (containers[0] == 'categories') and (category is not None):
+                    if 'key' in category:
+                        keys[category.get ('$self')] = category['key']
+                        levels[depth]['categories'].append (category['key'])
+                    elif category.get ('$ref') in keys:
+                        levels[depth]['categories'].append (keys[category['$ref']])
+                    category = None
+                elif (len (containers) == 1) and (containers[0] == 'categories'):
+                    levels[depth]['done'] = True
+                containers.pop ()
+        elif (len (containers) == 0) and (key == 'id') and (event == 'number'):
+            levels[depth]['id'] = int (value)
+        elif (len (containers) == 2) and (containers[0] == 'categories') and (category is not None):
+            category[key] = value
+        while (nextDepth < len (levels)) and levels[nextDepth]['done'] and (levels[nextDepth]['id'] is not None):
+            yield (levels[nextDepth]['id'], levels[nextDepth]['categories'])
+            nextDepth += 1
+
+def getAncestry (wsid, baseCategory="Baseline", baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get [[id, [category keys]], ...] of the worldstate and its (grand*)parents,
+    current worldstate first, up to and including the first with baseCategory
+
+    The level=1000 response is parsed while it is read; reading stops at the base worldstate.
     """
     # http://crisma.cismet.de/pilotC/icmm_api/CRISMA.worldstates/3?level=1000&fields=parentworldstate%2Ccategories&omitNullValues=true&deduplicate=true
-    # get (grand*)parent worldstate list
     params = {
         'level' :  1000,
         'fields' : "parentworldstate,categories,key,id",
@@ -240,28 +504,35 @@ def getParentWorldstates (wsid, baseCategory="Baseline", baseUrl=defaultBaseUrl,
         'deduplicate' : 'true'
         }
     headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
+    def extract (response):
+        ancestry = []
+        for (id, categories) in iterAncestry (JSONstream.events (response.iter_content (HTTP.chunkSize))):
+            ancestry.append ([id, categories])
+            if baseCategory in categories:
+                break
+        return ancestry
+    url = "{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid)
+    return HTTP.cache.getValue (url, extract, params=params, ttl=metadataCacheTtl, variant=baseCategory, headers=headers, verify=False)
 
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
+def getBaseWorldstate (wsid, baseCategory="Baseline", baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get parent worldstate id with given category or None
+    
+    default baseCategory: "Baseline". Other posibilities: "Template"
+    """
+    ancestry = getAncestry (wsid, baseCategory=baseCategory, baseUrl=baseUrl, domain=domain)
+    if (len (ancestry) > 0) and (baseCategory in ancestry[-1][1]):
+        return ancestry[-1][0]
+    return None
 
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
-    worldstates = []
-    while (True):
-        worldstates.insert (0, worldstate['id'])
-        if ('categories' in worldstate):
-            for c in worldstate['categories']:
-                if c['key'] == baseCategory:                
-                    return worldstates
-        if ('parentworldstate' not in worldstate):
-            return None
-        worldstate =  worldstate['parentworldstate']
-    return None # never reach this, just to see the end of the function.
+def getParentWorldstates (wsid, baseCategory="Baseline", baseUrl=defaultBaseUrl, domain=defaultDomain):
+    """Get parent worldstate ids uo and including the first with the given category or None
+    
+    default baseCategory: "Baseline". Other posibilities: "Template"
+    """
+    ancestry = getAncestry (wsid, baseCategory=baseCategory, baseUrl=baseUrl, domain=domain)
+    if (len (ancestry) > 0) and (baseCategory in ancestry[-1][1]):
+        return [id for (id, categories) in reversed (ancestry)]
+    return None
 
 
 
@@ -273,128 +544,138 @@ def getIndicatorURL (wsid, name, baseUrl=defaultBaseUrl, domain=defaultDomain):
     returns: ICMM indicator URL (dataitem)
     """
     # Get worldstate 
-    ICMMindicatorURL = None
     params = {
         'level' :  2,
         'fields' : "worldstatedata,name,categories",
         'omitNullValues' : 'true',
         'deduplicate' : 'true'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
-
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
-
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
-
-    # t = time.time() * 1000
-    t = datetime.datetime.utcnow().isoformat()
+    worldstate = getWorldstate (wsid, params, baseUrl=baseUrl, domain=domain)
 
     ICMMindicatorURL = None
-    # check if the indicator is already in the ICMM worldstate
-    if (worldstate['worldstatedata'] is not None):
-        for d in worldstate['worldstatedata']:
-            if ('categories' in d):
-                for c in d['categories']:
-                    if ((c['$ref'] == "/{0}.categories/{1}".format (domain, categoryIdIndicatorValue)) and (d['name'] == name)):
-                        # An indicator value with the given name is already there
-                        ICMMindicatorURL = "{0}{1}".format (baseUrl, d['$self'])
+    d = findIndicatorDataitem (worldstate, name, baseUrl=baseUrl, domain=domain)
+    if d is not None:
+        # An indicator value with the given name is already there
+        ICMMindicatorURL = "{0}{1}".format (baseUrl, d['$self'])
     return ICMMindicatorURL
 
 
-def addIndicatorValToICMM (wsid, name, description, value, baseUrl=defaultBaseUrl, domain=defaultDomain):
+def addIndicatorValToICMM (wsid, name, description, value, baseUrl=defaultBaseUrl, domain=defaultDomain, snapshot=None):
     """Add an indicator value 
 
     wsid: id within ICMM
     value: indicator-value as json structure
+    snapshot: WorldstateSnapshot of wsid to be used instead of reading the worldstate again
 
     returns: ICMM indicator URL (dataitem)
     """
-    # Get worldstate 
-    ICMMindicatorURL = None
-    params = {
-        'level' :  2,
-        'fields' : "worldstatedata,name,categories",
-        'omitNullValues' : 'true',
-        'deduplicate' : 'true'
-        }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
+    return addIndicatorValuesToICMM (wsid, [(name, description, value)], baseUrl=baseUrl, domain=domain, snapshot=snapshot)[0]
 
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
+def addIndicatorValuesToICMM (wsid, values, baseUrl=defaultBaseUrl, domain=defaultDomain, snapshot=None):
+    """Add several indicator values with one worldstate update
 
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
+    Existing indicator dataitems are updated in place, new ones are appended.
+    All of them are written with a single PUT of the worldstate.
+
+    wsid: id within ICMM
+    values: list of (name, description, value); value: indicator-value as json structure
+    snapshot: WorldstateSnapshot of wsid to be used instead of reading the worldstate again
+
+    returns: list of ICMM indicator URLs (dataitems), same order as values
+    """
+    headers = {'content-type': 'application/json'}
+    # Get worldstate 
+    if snapshot is not None:
+        worldstate = snapshot.worldstate
+    else:
+        params = {
+            'level' :  2,
+            'fields' : "worldstatedata,name,categories",
+            'omitNullValues' : 'true',
+            'deduplicate' : 'true'
+            }
+        worldstate = getWorldstate (wsid, params, baseUrl=baseUrl, domain=domain)
 
     t = datetime.datetime.utcnow().isoformat()
 
-    # check if the indicator is already in the ICMM worldstate
-    if (worldstate['worldstatedata'] is not None):
-        for d in worldstate['worldstatedata']:
-            if ('categories' in d):
-                for c in d['categories']:
-                    if ((c['$ref'] == "/{0}.categories/{1}".format (domain, categoryIdIndicatorValue)) and (d['name'] == name)):
-                        # An indicator value with the given name is already there
-                        ICMMindicatorURL = "{0}{1}".format (baseUrl, d['$self'])
-                        logging.info ("Update indicator found at " + ICMMindicatorURL)
-                        data = {
-                            '$self': d['$self'],
-                            'actualaccessinfo': json.dumps (value),
-                            'lastmodified': t
-                            }
-                        # store dataitem back
-                        params = {}
-                        response = requests.put(ICMMindicatorURL, params=params, headers=headers, data=json.dumps (data), verify=False) 
-                        if response.status_code != 200:
-                            raise Exception ("Error writing dataitem to ICMM at {0}: {1}".format (response.url, response.status_code))   
-                        return ICMMindicatorURL    
-                        
-    # New indicator in this worldstate
-    dataitemsId = getId ("dataitems", baseUrl=baseUrl);
-        
-    data = {
-        "$self": "/{0}.dataitems/{1}".format (domain, dataitemsId),
-        "id": dataitemsId,
-        "name": name,
-        "description": description,
-        "categories": [
-            {
-                "$ref": "/{0}.categories/{1}".format (domain, categoryIdIndicatorValue)
-                }
-            ],
-        "datadescriptor": {
-            "$ref": "/{0}.datadescriptors/{1}".format (domain, datadescriptorIdIndicatorValue)
-            },
-        "actualaccessinfocontenttype": "application/json",
-        "actualaccessinfo": json.dumps (value),
-        "lastmodified": t
-        }
-        
+    # one block of ids for all new dataitems
+    newNames = []
+    for (name, description, value) in values:
+        if (findIndicatorDataitem (worldstate, name, baseUrl=baseUrl, domain=domain) is None) and (name not in newNames):
+            newNames.append (name)
+    newIds = getIds ("dataitems", len (newNames), baseUrl=baseUrl) if len (newNames) > 0 else []
+
+    ICMMindicatorURLs = []
+    updated = {}   # $self -> dataitem
+    created = []
+    for (name, description, value) in values:
+        # check if the indicator is already in the ICMM worldstate (or in this list)
+        d = findIndicatorDataitem (worldstate, name, baseUrl=baseUrl, domain=domain)
+        if d is None:
+            for data in created:
+                if data['name'] == name:
+                    d = data
+        if d is not None:
+            # An indicator value with the given name is already there
+            logging.info ("Update indicator found at {0}{1}".format (baseUrl, d['$self']))
+            if d in created:
+                d['actualaccessinfo'] = json.dumps (value)
+            else:
+                updated[d['$self']] = {
+                    '$self': d['$self'],
+                    'actualaccessinfo': json.dumps (value),
+                    'lastmodified': t
+                    }
+            ICMMindicatorURLs.append ("{0}{1}".format (baseUrl, d['$self']))
+            continue
+
+        # New indicator in this worldstate
+        dataitemsId = newIds[len (created)]
+        data = {
+            "$self": "/{0}.dataitems/{1}".format (domain, dataitemsId),
+            "id": dataitemsId,
+            "name": name,
+            "description": description,
+            "categories": [
+                {
+                    "$ref": "/{0}.categories/{1}".format (domain, constants (baseUrl, domain)['categoryIdIndicatorValue'])
+                    }
+                ],
+            "datadescriptor": {
+                "$ref": "/{0}.datadescriptors/{1}".format (domain, constants (baseUrl, domain)['datadescriptorIdIndicatorValue'])
+                },
+            "actualaccessinfocontenttype": "application/json",
+            "actualaccessinfo": json.dumps (value),
+            "lastmodified": t
+            }
+        created.append (data)
+        ICMMindicatorURLs.append ("{0}/{1}.dataitems/{2}".format (baseUrl, domain, dataitemsId))
+
+    if snapshot is not None:
+        # The snapshot may be old by now; other indicators may have added their dataitems in the meantime.
+        # Re-read the (small) list of references only, so nothing gets lost (also if nothing was created:
+        # the PUT replaces the whole list).
+        refs = getWorldstate (wsid, snapshot.refParams, baseUrl=baseUrl, domain=domain)
+    else:
+        refs = worldstate
     wsdata = []
-    if ('worldstatedata' in worldstate):
-        for wsd in worldstate['worldstatedata']:
-            wsdata.append ({'$ref': wsd['$self']})
-    wsdata.append (data)
+    if ('worldstatedata' in refs):
+        for wsd in refs['worldstatedata']:
+            ref = refOf (wsd)
+            if ref in updated:
+                wsdata.append (updated[ref])
+            else:
+                wsdata.append ({'$ref': ref})
+    # dataitems no longer referenced by the worldstate are not touched
+    wsdata.extend (created)
     ws = {
         '$self' : worldstate['$self'],
         'worldstatedata' : wsdata
         }
-    ICMMindicatorURL = "{0}/{1}.dataitems/{2}".format (baseUrl, domain, dataitemsId)
 
     # store worldstate back
     params = {}
-    response = requests.put("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, data=json.dumps (ws), verify=False) 
+    response = HTTP.put ("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, data=json.dumps (ws), verify=False) 
 
     # Check why ICMM is not always sending events
     logging.info ("AddIndicatorToICMM: PUT {0}/{1}.{2}/{3} -- DATA = {4}".format (baseUrl, domain, "worldstates", wsid, json.dumps (ws).replace ("\n", ""))) 
@@ -403,69 +684,74 @@ def addIndicatorValToICMM (wsid, name, description, value, baseUrl=defaultBaseUr
         raise Exception ("Error writing worldstate to ICMM at {0}: {1}".format (response.url, response.status_code))
     # This is now stored in ICMM: response.json()
 
-    return ICMMindicatorURL    
+    if snapshot is not None:
+        for d in worldstate.get ('worldstatedata', []):
+            if d.get ('$self') in updated:
+                d['actualaccessinfo'] = updated[d['$self']]['actualaccessinfo']
+        worldstate.setdefault ('worldstatedata', []).extend (created)
+    return ICMMindicatorURLs
 
-def addKpiValToICMM (wsid, name, description, value, baseUrl=defaultBaseUrl, domain=defaultDomain):
-    """Add an kpi value 
+def mergeKpi (icc, value):
+    """Merge the kpi groups of value into icc (both as json structure)
+
+    returns icc
+    """
+    if icc is None:
+        icc = {}
+    for group in value:
+        # logging.info ("   group = {0}".format (group))
+        if group in icc:
+            for name in value[group]:
+                # logging.info ("    name = {0}".format(name))
+                icc[group][name] = value[group][name]
+        else:
+            icc[group] = value[group]
+    return icc
+
+def iccdataVersion (iccdata):
+    """Version of an iccdata dataitem: ICMM has none, its lastmodified and content stand for it"""
+    return (iccdata.get ('lastmodified'), iccdata.get ('actualaccessinfo'))
+
+def writeKpi (wsid, kpi, baseUrl=defaultBaseUrl, domain=defaultDomain, snapshot=None):
+    """Merge kpi groups into the iccdata of a worldstate
+
+    ICMM has no conditional PUT: iccdata is read again right before the PUT and
+    if its version (iccdataVersion) is not the one merged into, the merge is
+    repeated with the new content (writers on this host are coalesced by KpiWriter).
+    If the answer to the PUT leaves open whether it was stored (gateway error)
+    iccdata is read again and the merge is repeated if the values are missing.
 
     wsid: id within ICMM
-    value: indicator-value as json structure
+    kpi: kpi groups as json structure
+    snapshot: WorldstateSnapshot of wsid, used for the iccdata reference and content and updated
 
-    returns: ICMM indicator URL (dataitem)
+    returns: ICMM kpi URL (dataitem)
     """
-    # Get worldstate 
+    headers = {'content-type': 'application/json'}
+    params = {}
     ICMMkpiURL = None
-    params = {
-        'level' :  2,
-        'fields' : "iccdata,name,actualaccessinfo",
-        'omitNullValues' : 'true',
-        'deduplicate' : 'true'
+    iccdataParams = {
+        'level': 1,
+        'fields': "name,actualaccessinfo,lastmodified",
+        'omitNullValues': 'true'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
-
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
-
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
+    if (snapshot is not None) and ('iccdata' in snapshot.worldstate) and (type (snapshot.worldstate['iccdata']) is not list):
+        ICMMkpiURL = "{0}{1}".format (baseUrl, refOf (snapshot.worldstate['iccdata']))
+    if ICMMkpiURL is None:
+        # iccdata may have been created since the snapshot was taken
+        worldstate = getWorldstate (wsid, {'level': 1, 'fields': "iccdata", 'omitNullValues': 'true', 'deduplicate': 'true'}, baseUrl=baseUrl, domain=domain)
+        # if iccdata = []
+        if ('iccdata' in worldstate) and (type (worldstate['iccdata']) is not list):
+            ICMMkpiURL = "{0}{1}".format (baseUrl, refOf (worldstate['iccdata']))
 
     # t = time.time() * 1000
     t = datetime.datetime.utcnow().isoformat()
 
-    icc = None
-    # check if there is already a kpi in the ICMM worldstate
-    if ('iccdata' in worldstate):
-        # if iccdata = []
-        if type (worldstate['iccdata']) is list:
-            pass
-        else:
-            ICMMkpiURL = "{0}{1}".format (baseUrl, worldstate['iccdata']['$self'])
-            iccString = worldstate['iccdata']['actualaccessinfo']
-            icc = json.loads (iccString)
-
-    # now merge data into icc 
-    logging.info ("    icc = {0}".format (icc))
-    logging.info ("    value = {0}".format (value))
-    if icc is None:
-        icc = value
-    else:
-        for group in value:
-            # logging.info ("   group = {0}".format (group))
-            if group in icc:
-                for name in value[group]:
-                    # logging.info ("    name = {0}".format(name))
-                    icc[group][name] = value[group][name]
-            else:
-                icc[group] = value[group]
-
+    logging.info ("    kpi = {0}".format (kpi))
     if ICMMkpiURL is None: 
         # There where no iccdata
         # create new dataitem - this will be the new ICMMkpiUrl
+        icc = mergeKpi (None, kpi)
         dataitemsId = getId ("dataitems", baseUrl=baseUrl);
         data = {
             "$self": "/{0}.dataitems/{1}".format (domain, dataitemsId),
@@ -474,7 +760,7 @@ def addKpiValToICMM (wsid, name, description, value, baseUrl=defaultBaseUrl, dom
             "description": "ICC Data by indicator WPS",
             "lastmodified": t,
             "datadescriptor": {
-                "$ref": "/{0}.datadescriptors/{1}".format (domain, datadescriptorIdICCdata)
+                "$ref": "/{0}.datadescriptors/{1}".format (domain, constants (baseUrl, domain)['datadescriptorIdICCdata'])
                 },
             "actualaccessinfocontenttype": "application/json",
             "actualaccessinfo": json.dumps (icc)
@@ -483,33 +769,184 @@ def addKpiValToICMM (wsid, name, description, value, baseUrl=defaultBaseUrl, dom
         ICMMkpiURL = "{0}{1}".format (baseUrl, data['$self'])
         logging.info ("ICMMkpiURL = {0}".format (ICMMkpiURL))
         # store dataitem back
-        params = {}
-        response = requests.put(ICMMkpiURL, params=params, headers=headers, data=json.dumps (data), verify=False) 
+        response = HTTP.put (ICMMkpiURL, params=params, headers=headers, data=json.dumps (data), verify=False) 
         if response.status_code != 200:
             logging.info (response.text)
             raise Exception ("Error writing dataitem to ICMM at {0}: {1}".format (response.url, response.status_code))   
         
         # update worldstate
-        worldstate['iccdata'] = {
-            '$ref': "/{0}.dataitems/{1}".format (domain, dataitemsId)
+        ws = {
+            '$self' : "/{0}.worldstates/{1}".format (domain, wsid),
+            'iccdata' : {
+                '$ref': "/{0}.dataitems/{1}".format (domain, dataitemsId)
+                }
             }
-        response = requests.put("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, data=json.dumps (worldstate), verify=False) 
+        response = HTTP.put ("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, data=json.dumps (ws), verify=False) 
         if response.status_code != 200:
             raise Exception ("Error updateing worldstate referencing new iccdata in ICMM at {0}: {1}".format (response.url, response.status_code))   
+        iccdata = data
 
     else:
         # Update iccdata dataitem only - ignore timestamps in worldstate (TODO?)
-        worldstate['iccdata']['actualaccessinfo'] = json.dumps (icc)
-        # store dataitem back
-        params = {}
-        response = requests.put(ICMMkpiURL, params=params, headers=headers, data=json.dumps (worldstate['iccdata']), verify=False) 
-        if response.status_code != 200:
-            raise Exception ("Error writing updated iccdata back to ICMM at {0}: {1}".format (response.url, response.status_code))   
+        if (snapshot is not None) and ('actualaccessinfo' in snapshot.worldstate.get ('iccdata', [])):
+            iccdata = snapshot.worldstate['iccdata']
+        else:
+            iccdata = getJson (ICMMkpiURL, iccdataParams)
+        attempt = 0
+        while True:
+            attempt += 1
+            icc = mergeKpi (json.loads (iccdata['actualaccessinfo']), kpi)
+            current = getJson (ICMMkpiURL, iccdataParams)
+            if iccdataVersion (current) != iccdataVersion (iccdata):
+                # written by somebody else since it was read
+                if attempt >= kpiWriteAttempts:
+                    raise Exception ("iccdata at {0} changed while merging ({1} attempts)".format (ICMMkpiURL, attempt))
+                logging.warning ("iccdata at {0} changed, merging again".format (ICMMkpiURL))
+                iccdata = current
+                continue
+            iccdata = current
+            iccdata['actualaccessinfo'] = json.dumps (icc)
+            iccdata['lastmodified'] = datetime.datetime.utcnow().isoformat()
+            # store dataitem back
+            response = HTTP.put (ICMMkpiURL, params=params, headers=headers, data=json.dumps (iccdata), verify=False) 
+            if response.status_code == 200:
+                break
+            if response.status_code not in HTTP.retryStatus:
+                raise Exception ("Error writing updated iccdata back to ICMM at {0}: {1}".format (response.url, response.status_code))   
+            # gateway error: the PUT may have been stored or not, are all kpi values there?
+            iccdata = getJson (ICMMkpiURL, iccdataParams)
+            check = json.loads (iccdata['actualaccessinfo'])
+            if mergeKpi (json.loads (json.dumps (check)), kpi) == check:
+                break
+            if attempt >= kpiWriteAttempts:
+                raise Exception ("Error writing updated iccdata back to ICMM at {0}: {1} ({2} attempts)".format (response.url, response.status_code, attempt))
+            logging.warning ("iccdata at {0} not written ({1}), merging again".format (ICMMkpiURL, response.status_code))
 
     logging.info ("AddKpiToICMM: PUT {0} -- DATA = {1}".format (ICMMkpiURL, json.dumps (icc).replace ("\n", ""))) 
 
+    if snapshot is not None:
+        snapshot.worldstate['iccdata'] = iccdata
     return ICMMkpiURL    
 
+
+class KpiWriter:
+    """Collects kpi values for one worldstate and writes them with one iccdata update
+
+    Writers on this host (e.g. the indicators started together by OrionListener)
+    put their values into a spool in the LocalStore. One of them (the flusher) 
+    writes everything spooled with one writeKpi, the others wait until their
+    values are written. If the LocalStore is not usable the values are written directly.
+
+    writer = KpiWriter (wsid, baseUrl)
+    writer.add (kpi1)
+    writer.add (kpi2)
+    ICMMkpiURL = writer.flush ()
+    """
+    namespace = 'ICMM-kpi'
+
+    def __init__ (self, wsid, baseUrl=defaultBaseUrl, domain=defaultDomain, snapshot=None):
+        self.wsid = wsid
+        self.baseUrl = baseUrl
+        self.domain = domain
+        self.snapshot = snapshot
+        self.kpi = {}
+        self.key = "{0}/{1}.worldstates/{2}".format (baseUrl, domain, wsid)
+
+    def __repr__ (self):
+        return "KpiWriter {0}".format (self.key)
+
+    def add (self, value):
+        """Add kpi groups (json structure) to be written"""
+        mergeKpi (self.kpi, json.loads (json.dumps (value)))
+
+    def claim (self, state):
+        """Become the flusher if there is none (or it did not finish within kpiFlushLease)"""
+        if state['flusher'] + kpiFlushLease < time.time ():
+            state['flusher'] = time.time ()
+            return True
+        return False
+
+    def flush (self):
+        """Write all added kpi values
+
+        returns: ICMM kpi URL (dataitem)
+        """
+        store = LocalStore.getStore ()
+        ticket = {}
+        def spool (state):
+            if state is None:
+                state = {'seq': 0, 'done': 0, 'pending': None, 'pendingSeq': 0, 'flusher': 0, 'url': None}
+            state['seq'] += 1
+            state['pending'] = mergeKpi (state['pending'], self.kpi)
+            state['pendingSeq'] = state['seq']
+            ticket['seq'] = state['seq']
+            ticket['flusher'] = self.claim (state)
+            return state
+        if store.update (self.namespace, self.key, spool) is None:
+            return writeKpi (self.wsid, self.kpi, self.baseUrl, self.domain, snapshot=self.snapshot)
+        kpi = self.kpi
+        self.kpi = {}
+
+        # wait until an other process has written our values or we are the flusher
+        while not ticket['flusher']:
+            HTTP.remaining ()   # raises HTTP.DeadlineExceeded
+            time.sleep (kpiWaitInterval)
+            state = store.get (self.namespace, self.key)
+            if state is None:
+                return writeKpi (self.wsid, kpi, self.baseUrl, self.domain, snapshot=self.snapshot)
+            if state['done'] >= ticket['seq']:
+                return state['url']
+            def claim (state):
+                ticket['flusher'] = self.claim (state)
+                return state
+            store.update (self.namespace, self.key, claim)
+
+        # flusher: write until the spool is empty
+        ICMMkpiURL = None
+        while True:
+            batch = {}
+            def take (state):
+                batch['kpi'] = state['pending']
+                batch['seq'] = state['pendingSeq']
+                batch['url'] = state['url']
+                state['pending'] = None
+                state['flusher'] = 0 if batch['kpi'] is None else time.time ()
+                return state
+            store.update (self.namespace, self.key, take)
+            if batch.get ('kpi') is None:
+                return ICMMkpiURL or batch.get ('url')
+            try:
+                ICMMkpiURL = writeKpi (self.wsid, batch['kpi'], self.baseUrl, self.domain, snapshot=self.snapshot)
+            except:
+                # give the values back, newer values in the spool win
+                def giveBack (state):
+                    state['pending'] = mergeKpi (batch['kpi'], state['pending'] or {})
+                    state['pendingSeq'] = max (state['pendingSeq'], batch['seq'])
+                    state['flusher'] = 0
+                    return state
+                store.update (self.namespace, self.key, giveBack)
+                raise
+            def done (state):
+                state['done'] = max (state['done'], batch['seq'])
+                state['url'] = ICMMkpiURL
+                return state
+            store.update (self.namespace, self.key, done)
+            store.evict (self.namespace, kpiSpoolBytes)
+
+
+def addKpiValToICMM (wsid, name, description, value, baseUrl=defaultBaseUrl, domain=defaultDomain, snapshot=None):
+    """Add an kpi value 
+
+    wsid: id within ICMM
+    value: indicator-value as json structure
+    snapshot: WorldstateSnapshot of wsid to be used instead of reading the worldstate again
+
+    returns: ICMM indicator URL (dataitem)
+    """
+    writer = KpiWriter (wsid, baseUrl=baseUrl, domain=domain, snapshot=snapshot)
+    writer.add (value)
+    return writer.flush ()
+
 ##############################
 # Pilot C specific
 
@@ -523,37 +960,34 @@ def getOOIRef (wsid, category, name=None, baseUrl=defaultBaseUrl, domain=default
     # get WorldState
     params = {
         'level' :  3,
-        'fields' : "worldstatedata,actualaccessinfo,key,categories,datadescriptor,defaultaccessinfo,name",
+        'fields' : "worldstatedata,actualaccessinfo,key,categories,datadescriptor,defaultaccessinfo,name,id",
         'omitNullValues' : 'true',
         'deduplicate' : 'false'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
+    worldstate = getWorldstate (wsid, params, baseUrl=baseUrl, domain=domain, cacheTtl=metadataCacheTtl)
 
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
+    return findOOIRef (worldstate, category, name=name)
 
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable(response.json) else response.json
+def findOOIRef (worldstate, category, name=None):
+    """Get the OOI reference within a dataitem of an already loaded ICMM worldstate (level 3, not deduplicated)
 
+    category: key of the category of the requested dataitem
+    name: id of indicator (None if this does not matter)
+    """
     dataitems = worldstate['worldstatedata']
     for d in dataitems:
       if ((name is None) or (name == d['name'])):
         if ('categories' in d):
             for c in d['categories']:
-                if c['key'] == category:
+                if c.get ('key') == category:
                     try:
                         access = json.loads (d['actualaccessinfo'])
                     except:
-                        raise Exception ("Could not load OOI access information for worldstate {0} - illegal JSON string?\n{1}\n".format (wsid, d['actualaccessinfo']))
+                        raise Exception ("Could not load OOI access information for worldstate {0} - illegal JSON string?\n{1}\n".format (worldstate['id'], d['actualaccessinfo']))
                     try:
                         service = json.loads (d['datadescriptor']['defaultaccessinfo'])
                     except:
-                        raise Exception ("Could not load OOI access information for worldstate {0} - illegal JSON string?\n{1}\n".format (wsid, d['actualaccessinfo']))
+                        raise Exception ("Could not load OOI access information for worldstate {0} - illegal JSON string?\n{1}\n".format (worldstate['id'], d['actualaccessinfo']))
                     return "{0}/{1}/{2}".format(service['endpoint'], access['resource'], access['id'])
     return None
 
@@ -565,6 +999,7 @@ def addIndicatorRefToICMM (wsid, name, description, ooiref, baseUrl=defaultBaseU
 
     returns: ICMM indicator URL (dataitem)
     """
+    headers = {'content-type': 'application/json'}
     # Get worldstate 
     ICMMindicatorURL = None
     params = {
@@ -573,25 +1008,14 @@ def addIndicatorRefToICMM (wsid, name, description, ooiref, baseUrl=defaultBaseU
         'omitNullValues' : 'true',
         'deduplicate' : 'true'
         }
-    headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, verify=False) 
-
-    if response.status_code != 200:
-        raise Exception ("Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
-    if response.text is None:
-        raise Exception ("No such ICMM WorldState")
-    if response.text == "":
-        raise Exception ("No such ICMM WorldState")
-
-    # Depending on the requests-version json might be an field instead of on method
-    worldstate = response.json() if callable (response.json) else response.json
+    worldstate = getWorldstate (wsid, params, baseUrl=baseUrl, domain=domain)
 
     # check if the indicator is already in the ICMM worldstate
     if (worldstate['worldstatedata'] is not None):
         for d in worldstate['worldstatedata']:
             if ('categories' in d):
                 for c in d['categories']:
-                    if ((c['$ref'] == "/{0}.categories/3".format (domain)) and (d['name'] == name)):
+                    if ((c['$ref'] == "/{0}.categories/{1}".format (domain, constants (baseUrl, domain)['categoryIdIndicatorRef'])) and (d['name'] == name)):
                         ICMMindicatorURL = "{0}{1}".format (baseUrl, d['$self'])
                         return ICMMindicatorURL
                         
@@ -609,11 +1033,11 @@ def addIndicatorRefToICMM (wsid, name, description, ooiref, baseUrl=defaultBaseU
         "description": description,
         "categories": [
             {
-                "$ref": "/{0}.categories/{1}".format (domain, categoryIdIndicatorRef)
+                "$ref": "/{0}.categories/{1}".format (domain, constants (baseUrl, domain)['categoryIdIndicatorRef'])
             }
         ],
         "datadescriptor": {
-            "$ref": "/{0}.datadescriptors/{1}".format (domain, datadescriptorIdOOIRef)
+            "$ref": "/{0}.datadescriptors/{1}".format (domain, constants (baseUrl, domain)['datadescriptorIdOOIRef'])
             },
         "actualaccessinfocontenttype": "URL",
         "actualaccessinfo": ooiref,
@@ -627,7 +1051,7 @@ def addIndicatorRefToICMM (wsid, name, description, ooiref, baseUrl=defaultBaseU
 
     # store worldstate back
     params = {}
-    response = requests.put("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, data=json.dumps (worldstate)) 
+    response = HTTP.put ("{0}/{1}.{2}/{3}".format (baseUrl, domain, "worldstates", wsid), params=params, headers=headers, data=json.dumps (worldstate)) 
 
     # Check why ICMM is not always sending events
     #logging.info ("AddIndicatorToICMM: PUT {0}/{1}.{2}/{3} -- DATA = {4}".format (baseUrl, domain, "worldstates", wsid, json.dumps (worldstate).replace ("\n", "")))
@@ -641,6 +1065,67 @@ def addIndicatorRefToICMM (wsid, name, description, ooiref, baseUrl=defaultBaseU
     return ICMMindicatorURL    
 
 
+class WorldstateSnapshot:
+    """ICMM worldstate loaded once with everything needed by an indicator run
+
+    Answers getNameDescription, getOOIRef and getIndicatorURL locally and
+    can be given to addIndicatorValToICMM / addKpiValToICMM as snapshot.
+    The writes depend on it, so a cached worldstate is always revalidated, never used by ttl.
+    """
+    # union of the fields used by getNameDescription, getOOIRef, getIndicatorURL, addIndicatorValToICMM and addKpiValToICMM
+    params = {
+        'level' :  3,
+        'fields' : "name,description,worldstatedata,iccdata,actualaccessinfo,lastmodified,key,categories,datadescriptor,defaultaccessinfo,id",
+        'omitNullValues' : 'true',
+        'deduplicate' : 'false'
+        }
+    # just the references to the dataitems
+    refParams = {
+        'level' :  1,
+        'fields' : "worldstatedata",
+        'omitNullValues' : 'true',
+        'deduplicate' : 'true'
+        }
+
+    def __init__ (self, wsid, baseUrl=defaultBaseUrl, domain=defaultDomain):
+        self.wsid = wsid
+        self.baseUrl = baseUrl
+        self.domain = domain
+        self.worldstate = getWorldstate (wsid, self.params, baseUrl=baseUrl, domain=domain, cacheTtl=0)
+
+    def __repr__ (self):
+        return "WorldstateSnapshot {0}/{1}.worldstates/{2}".format (self.baseUrl, self.domain, self.wsid)
+
+    def getNameDescription (self):
+        return {
+            'ICMMname' : self.worldstate["name"],
+            'ICMMdescription' : self.worldstate["description"]
+            }
+
+    def getOOIRef (self, category, name=None):
+        return findOOIRef (self.worldstate, category, name=name)
+
+    def getIndicatorURL (self, name):
+        d = findIndicatorDataitem (self.worldstate, name, baseUrl=self.baseUrl, domain=self.domain)
+        if d is None:
+            return None
+        return "{0}{1}".format (self.baseUrl, d['$self'])
+
+    def getIndicatorValue (self, name):
+        """Stored indicator value (json structure) or None"""
+        d = findIndicatorDataitem (self.worldstate, name, baseUrl=self.baseUrl, domain=self.domain)
+        if (d is None) or (d.get ('actualaccessinfo') is None):
+            return None
+        return json.loads (d['actualaccessinfo'])
+
+    def getKpi (self):
+        """(ICMM kpi URL, stored kpi groups as json structure) or (None, None)"""
+        icc = self.worldstate.get ('iccdata')
+        if (type (icc) is not dict) or (icc.get ('actualaccessinfo') is None):
+            return (None, None)
+        return ("{0}{1}".format (self.baseUrl, refOf (icc)), json.loads (icc['actualaccessinfo']))
+
+
 ##############################
 # Pilot Ev1 specific
 
@@ -653,7 +1138,7 @@ def getCaptureData (worldstate):
         'deduplicate' : 'true'
         }
     headers = {'content-type': 'application/json'}
-    response = requests.get("{0}/{1}.{2}/{3}".format (worldstate.endpoint, worldstate.domain, "worldstates", worldstate.id), params=params, headers=headers, verify=False) 
+    response = HTTP.get ("{0}/{1}.{2}/{3}".format (worldstate.endpoint, worldstate.domain, "worldstates", worldstate.id), params=params, headers=headers, verify=False) 
     if response.status_code != 200:
         raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
     # Depending on the requests-version json might be an field instead of on method
@@ -688,7 +1173,7 @@ def getCaptureData (worldstate):
 
     params = {}
     headers = {'content-type': 'application/json'}
-    response = requests.get(captureDataURL, params=params, headers=headers, verify=False) 
+    response = HTTP.get (captureDataURL, params=params, headers=headers, verify=False) 
     if response.status_code != 200:
         raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
     # Depending on the requests-version json might be an field instead of on method
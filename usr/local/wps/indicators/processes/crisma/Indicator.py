@@ -29,26 +29,178 @@ Indicators and KPI are stored in ICMM
 from pywps.Process import WPSProcess                                
 from sys import stderr
 import json
-import requests
+import HTTPtools as HTTP
 import urllib
 from xml.sax.saxutils import escape
 import time
 import logging
+import dateutil.parser
+import hashlib
+import sys
+import os
+import fcntl
 
 import ICMMtools as ICMM
 import OOItools as OOI
+import ThreadPool
+import LocalStore
+
+######################
+#  Configuration
+foldStateBytes = 16 * 1024 * 1024   # disk space for the saved state of chain-walking indicators (LocalStore)
+resultBytes = 16 * 1024 * 1024      # disk space for the input fingerprints of the stored results (LocalStore)
+workers = 4                         # indicator executions calculating at the same time, asynchronous ones wait for a free worker
+workerPath = '/tmp/crisma-indicators-worker'   # lock files of the workers: <workerPath>-<n>.lock
+workerPoll = 1                      # seconds between the checks for a free worker
+workerMaxWait = 600                 # seconds an asynchronous execution waits for a free worker before it fails
+#####################
+
+foldStateNamespace = 'indicator-state'
+resultNamespace = 'indicator-results'
+
+
+class DataPlan:
+    """Inputs declared by indicators (requires), loaded before calculateIndicator
+
+    requires of an indicator:
+      'actual':   etpids of the actual OOI WorldState (OOI.prefetch)
+      'baseline': etpids of the Baseline OOI WorldState (OOI.getBaseline for patientExposedPropertyId / patientLifePropertyId)
+      'chain':    etpids of all OOI WorldStates from the Baseline on (changes against the parent, see loadOOIWorldstate),
+                  loaded while the indicators walk the chain: the etpids of all indicators with one load per worldstate
+      'times':    True if the simulated time of the Baseline and the actual ICMM WorldState is needed
+
+    Inputs needed by several indicators are loaded once, independent inputs at the same time.
+    """
+    def __init__ (self, indicators):
+        self.actual = set ()
+        self.baseline = set ()
+        self.chain = set ()
+        self.times = False
+        for indicator in indicators:
+            requires = indicator.requires or {}
+            self.actual.update (requires.get ('actual', []))
+            self.baseline.update (requires.get ('baseline', []))
+            self.chain.update (requires.get ('chain', []))
+            self.times = self.times or requires.get ('times', False)
+
+    def __repr__ (self):
+        return "DataPlan actual={0}, baseline={1}, chain={2}, times={3}".format (sorted (self.actual), sorted (self.baseline), sorted (self.chain), self.times)
+
+    def load (self, indicator):
+        """Load the inputs for the worldstate of indicator (ICMMworldstate and OOIworldstate are known)"""
+        logging.info ("load {0}".format (self))
+        loads = []
+        if len (self.actual) > 0:
+            loads.append (ThreadPool.submit (OOI.prefetch, indicator.OOIworldstate.id, sorted (self.actual), baseUrl=indicator.OOIworldstate.endpoint))
+        if self.times:
+            loads.append (ThreadPool.submit (indicator.getSimulatedTime, indicator.ICMMworldstate.id))
+        if (len (self.baseline) > 0) or (len (self.chain) > 0) or self.times:
+            # while the actual worldstate is loading
+            parents = indicator.getParents ()
+            if parents is not None:
+                if len (self.baseline) > 0:
+                    loads.append (ThreadPool.submit (self.loadBaseline, indicator))
+                if self.times:
+                    loads.append (ThreadPool.submit (indicator.getSimulatedTime, parents[0]))
+        # the chain is walked lazily by the indicators (iterOOIWorldstates), they may stop early
+        indicator.chainEtpids = sorted (self.chain)
+        ThreadPool.wait (loads)
+
+    def loadBaseline (self, indicator):
+        baseOOIworldstate = indicator.getBaseOOIWorldstate ()
+        others = self.baseline - set ([OOI.patientExposedPropertyId, OOI.patientLifePropertyId])
+        cached = indicator.isAncestor (baseOOIworldstate)
+        if len (others) < len (self.baseline):
+            OOI.getBaseline (baseOOIworldstate.id, baseUrl=indicator.OOIworldstate.endpoint, cached=cached)
+        if len (others) > 0:
+            OOI.prefetch (baseOOIworldstate.id, sorted (others), baseUrl=indicator.OOIworldstate.endpoint, cached=cached)
+
+
+def acquireWorker (maxWait=None):
+    """Lock one of the worker slots, wait until one is free
+
+    maxWait: seconds to wait at most, None: workerMaxWait
+
+    returns the open lock file; closing it (or the end of the execution) frees the worker
+            or None if no worker got free within maxWait
+    """
+    if maxWait is None:
+        maxWait = workerMaxWait
+    end = time.time () + maxWait
+    while True:
+        for n in range (workers):
+            path = "{0}-{1}.lock".format (workerPath, n)
+            lock = open (path, 'a')
+            try:
+                os.chmod (path, 0666)   # shared by all users running pywps
+            except OSError:
+                pass
+            try:
+                fcntl.flock (lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except IOError:
+                lock.close ()
+        if time.time () >= end:
+            return None
+        time.sleep (workerPoll)
+
+
+# hash of the crisma modules, see Indicator.codeVersion
+_libraryVersion = None
+
+def libraryVersion ():
+    """Hash of the sources of the crisma modules used by all indicators"""
+    global _libraryVersion
+    if _libraryVersion is None:
+        directory = os.path.dirname (os.path.abspath (__file__))
+        sha1 = hashlib.sha1 ()
+        for name in sorted (os.listdir (directory)):
+            if name.endswith ('.py'):
+                with open (os.path.join (directory, name), 'rb') as f:
+                    sha1.update (name)
+                    sha1.update (f.read ())
+        _libraryVersion = sha1.hexdigest ()
+    return _libraryVersion
+
+
+class Timings:
+    """Wall time of the phases of an execution, a phase starts with each status.set"""
+    def __init__ (self):
+        self.start = time.time ()
+        self.phases = []            # [[phase, seconds]]
+        self.phaseStart = self.start
+        self.cache = HTTP.cache.stats ()
+
+    def mark (self, phase):
+        now = time.time ()
+        if len (self.phases) > 0:
+            self.phases[-1][1] = round (now - self.phaseStart, 3)
+        self.phases.append ([phase, None])
+        self.phaseStart = now
+
+    def result (self):
+        """Phases, upstream calls, bytes and records per service and HTTP cache use of the execution"""
+        self.mark ("end")
+        cache = HTTP.cache.stats ()
+        return {
+            'seconds': round (time.time () - self.start, 3),
+            'phases': [{'phase': phase, 'seconds': seconds} for (phase, seconds) in self.phases[:-1]],
+            'upstream': HTTP.counters.get (),
+            'cache': dict ((key, cache[key] - self.cache[key]) for key in cache)
+            }
+
 
 class Indicator(WPSProcess):
 
-    def __init__(self, identifier, version, title, abstract, hasOOI = True):
+    def __init__(self, identifier, version, title, abstract, hasOOI = True, requires = None):
         # init process
         WPSProcess.__init__(
             self,
             identifier=identifier,
             version = version,
             title=title,
-            storeSupported = "false",
-            statusSupported = "false",
+            storeSupported = "true",
+            statusSupported = "true",
             abstract=abstract,
             grassLocation = False)
         self.ICMMworldstateURL = self.addLiteralInput (identifier = "ICMMworldstateURL",
@@ -69,13 +221,24 @@ class Indicator(WPSProcess):
         self.statusmessage=self.addLiteralOutput(identifier = "statusmessage",
                                        type = type (""),
                                        title = "execution status")
+        self.timings=self.addLiteralOutput(identifier = "timings",
+                                       type = type (""),
+                                       title = "execution time per phase and upstream calls")
         # for ICMM and OOI
         self.doUpdate = 1              # 1: recalculate existing indicator; 0: use existing value
         self.ICMMworldstate = None     # Access-object for ICMM WorldState
+        self.worldstateSnapshot = None # ICMM WorldState loaded once, see ICMM.WorldstateSnapshot
         self.worldstateDescription = None  # description of WorldState: ICMMname, ICMMdescription, ICMMworldstateURL, OOIworldstateURL
         self.hasOOI = hasOOI           # Provide access to OOI
         self.OOIworldstate = None      # Access-object for OOI-WSR WorldState
         self.result = None             # to be filled from calcualteIndicators(self)
+        self.timeBudget = HTTP.executionBudget  # seconds for all ICMM / OOI calls of one execution
+        self.requires = requires       # inputs loaded before calculateIndicator, see DataPlan
+        self.parents = None            # ICMM WorldState ids from the Baseline to the actual one, see getParents
+        self.baseOOIworldstate = None  # Access-object for the OOI-WSR WorldState of the Baseline
+        self.simulatedTimes = {}       # ICMM WorldState id -> simulatedTime, see getSimulatedTime
+        self.chainEtpids = []          # etpids of the chain of all indicators calculated together, see DataPlan
+        self.ooiWorldstates = {}       # ICMM WorldState id -> getOOIWorldstate result
 
     """
     def calculateIndicator(self):
@@ -134,8 +297,337 @@ class Indicator(WPSProcess):
         duration = duration / 60 
         return duration
 
-                          
+    def getOOIWorldstate (self, wsid):
+        """OOIAccess of the OOI WorldState referenced by ICMM WorldState wsid or (None, error message)"""
+        if wsid not in self.ooiWorldstates:
+            self.ooiWorldstates[wsid] = self.resolveOOIWorldstate (wsid)
+        return self.ooiWorldstates[wsid]
+
+    def resolveOOIWorldstate (self, wsid):
+        ooiWorldstateURL = ICMM.getOOIRef (wsid, 'OOI-worldstate-ref', baseUrl=self.ICMMworldstate.endpoint)
+        logging.info ("  ooiWorldstateURL = {0}".format (ooiWorldstateURL))
+        if (ooiWorldstateURL is None):
+            return (None, "invalid OOI URL: {0}".format (ooiWorldstateURL))
+        # OOI-URL -> Endpoint, id, ...
+        ooiWorldstate = OOI.OOIAccess(ooiWorldstateURL)
+        if (ooiWorldstate.endpoint is None):
+            return (None, "invalid OOI ref: {0}".format (ooiWorldstate))
+        return (ooiWorldstate, None)
+
+    def getParents (self):
+        """ICMM WorldState ids from the Baseline up to and including the actual one or None (see ICMM.getParentWorldstates)"""
+        if self.parents is None:
+            self.parents = ICMM.getParentWorldstates (self.ICMMworldstate.id, baseCategory="Baseline", baseUrl=self.ICMMworldstate.endpoint)
+        return self.parents
+
+    def getSimulatedTime (self, wsid):
+        """simulatedTime of an ICMM WorldState as datetime"""
+        if wsid in self.simulatedTimes:
+            return self.simulatedTimes[wsid]
+        params = {
+            'level' :  1,
+            'fields' : "simulatedTime",
+            'omitNullValues' : 'true',
+            'deduplicate' : 'true'
+            }
+        headers = {'content-type': 'application/json'}
+        response = HTTP.cache.get ("{0}/{1}.{2}/{3}".format (self.ICMMworldstate.endpoint, self.ICMMworldstate.domain, "worldstates", wsid), params=params, ttl=ICMM.metadataCacheTtl, headers=headers)
+        if response.status_code != 200:
+            raise Exception ( "Error accessing ICMM at {0}: {1}".format (response.url, response.status_code))
+        # Depending on the requests-version json might be an field instead of on method
+        jsonData = response.json() if callable (response.json) else response.json
+
+        ts = jsonData['simulatedTime']
+        if (len(ts) == 16):
+            ts = ts + ":00.0Z"
+        self.simulatedTimes[wsid] = dateutil.parser.parse (ts)
+        return self.simulatedTimes[wsid]
+
+    def getBaseOOIWorldstate (self):
+        """OOIAccess of the OOI WorldState of the Baseline of the actual ICMM WorldState"""
+        if self.baseOOIworldstate is None:
+            parents = self.getParents ()
+            if (parents is None):
+                raise Exception ("Base ICMM WorldState not found for actual ICMM WorldState = {0}".format (self.ICMMworldstate))
+            (baseOOIworldstate, error) = self.getOOIWorldstate (parents[0])
+            if (baseOOIworldstate is None):
+                raise Exception (error)
+            logging.info ("baseOOIWorldState = {0}".format (baseOOIworldstate))
+            self.baseOOIworldstate = baseOOIworldstate
+        return self.baseOOIworldstate
+
+    def isAncestor (self, ooiWorldstate):
+        """True if ooiWorldstate is not the actual OOI WorldState: it does not change any more and may be cached"""
+        return ooiWorldstate.id != self.OOIworldstate.id
+
+    def getBaseline (self):
+        """OOI.Baseline of the exercise: patients taking part and their life at the start"""
+        baseOOIworldstate = self.getBaseOOIWorldstate ()
+        return OOI.getBaseline (baseOOIworldstate.id, baseUrl=self.OOIworldstate.endpoint, cached=self.isAncestor (baseOOIworldstate))
+
+    def loadOOIWorldstate (self, wsid, etpids, parentWsid=None):
+        """EntityProperties with the given etpids of the OOI WorldState referenced by ICMM WorldState wsid
+
+        parentWsid: ICMM WorldState already evaluated, only the changes since then are returned (see OOI.getDelta)
+
+        returns (ooiWorldstate, [EntityProperty new or changed], [(entityId, etpid) removed]) or (None, error message, None)
+        """
+        logging.info ("get ws {0}".format (wsid))
+        (ooiWorldstate, error) = self.getOOIWorldstate (wsid)
+        if (ooiWorldstate is None):
+            return (None, error, None)
+        ooiParentId = None
+        if (parentWsid is not None):
+            (ooiParent, error) = self.getOOIWorldstate (parentWsid)
+            if (ooiParent is None):
+                return (None, error, None)
+            ooiParentId = ooiParent.id
+        logging.info("Request input data for OOI WorldState = {0} (changes since {1})".format (ooiWorldstate.id, ooiParentId))
+        wanted = set (etpids)
+        if wanted <= set (self.chainEtpids):
+            # one load per worldstate for all indicators (OOI.loadWorldstate keeps it)
+            (changes, removed) = OOI.getDelta (ooiWorldstate.id, ooiParentId, self.chainEtpids, baseUrl=self.OOIworldstate.endpoint, cached=self.isAncestor (ooiWorldstate))
+            return (ooiWorldstate, [ep for ep in changes if ep["entityTypePropertyId"] in wanted], [key for key in removed if key[1] in wanted])
+        (changes, removed) = OOI.getDelta (ooiWorldstate.id, ooiParentId, etpids, baseUrl=self.OOIworldstate.endpoint, cached=self.isAncestor (ooiWorldstate))
+        return (ooiWorldstate, changes, removed)
+
+    def iterOOIWorldstates (self, wsids, etpids, parentWsid=None):
+        """Yield (wsid, ooiWorldstate, [EntityProperty], [(entityId, etpid) removed]) for the ICMM WorldStates wsids in order, see loadOOIWorldstate
+
+        Only the changes since the previous worldstate (parentWsid for the first one) are returned.
+        The worldstates are loaded in parallel (ThreadPool.maxWorkers ahead of the caller).
+        Leaving the loop early cancels the loads not started yet.
+        """
+        pairs = zip ([parentWsid] + wsids[:-1], wsids)
+        loads = ThreadPool.imap (lambda (parent, wsid): (wsid,) + self.loadOOIWorldstate (wsid, etpids, parent), pairs)
+        try:
+            for data in loads:
+                yield data
+        finally:
+            loads.close ()
+
+    def foldStateKey (self, wsid):
+        return "{0}/{1}/{2}/{3}/{4}".format (self.ICMMworldstate.endpoint, self.ICMMworldstate.domain, wsid, self.identifier, self.version)
+
+    def loadFoldState (self, wsids):
+        """State saved by saveFoldState for the nearest worldstate of the chain wsids (Baseline first)
+
+        returns (number of worldstates covered by the state, state) or (0, None)
+        """
+        store = LocalStore.getStore ()
+        for index in range (len (wsids) - 1, -1, -1):
+            saved = store.get (foldStateNamespace, self.foldStateKey (wsids[index]), touch=True)
+            # the state is only valid for the same chain
+            if (saved is None) or (saved['chain'] != wsids[:index + 1]):
+                continue
+            # a state of the actual worldstate only for the same data, see saveFoldState
+            if ('data' in saved) and ((index < len (wsids) - 1) or (saved['data'] != self.foldStateData ())):
+                continue
+            logging.info ("resume from saved state of ws {0}".format (wsids[index]))
+            return (index + 1, saved['state'])
+        return (0, None)
+
+    def saveFoldState (self, wsids, index, state):
+        """Save the (json) state of the indicator after evaluating the worldstates wsids[:index+1]
+
+        A child worldstate evaluates only the worldstates after it, see loadFoldState.
+        The actual worldstate (the last of wsids) may still change: its state is kept
+        with the hash of its data and not used by the children.
+        """
+        saved = {'chain': wsids[:index + 1], 'state': state}
+        if index == len (wsids) - 1:
+            saved['data'] = self.foldStateData ()
+        store = LocalStore.getStore ()
+        store.put (foldStateNamespace, self.foldStateKey (wsids[index]), saved)
+        store.evict (foldStateNamespace, foldStateBytes)
+
+    def foldStateData (self):
+        """Hash of the chain EntityProperties of the actual OOI WorldState, see saveFoldState"""
+        return self.actualDataHash (DataPlan ([self]))
+
+    def codeVersion (self):
+        """version and hash of the source of the indicator and of the crisma modules: a changed calculation invalidates the stored results"""
+        try:
+            source = sys.modules[self.__module__].__file__
+            if source.endswith ('.pyc'):
+                source = source[:-1]
+            with open (source, 'rb') as f:
+                return "{0}:{1}:{2}".format (self.version, hashlib.sha1 (f.read ()).hexdigest (), libraryVersion ())
+        except (IOError, KeyError, AttributeError):
+            return self.version
+
+    def inputPlan (self):
+        """DataPlan of the inputs declared by the indicator or None if it does not declare them"""
+        if self.requires is None:
+            return None
+        return DataPlan ([self])
+
+    def actualDataHash (self, plan):
+        """Hash of the EntityProperties of plan read from the actual OOI WorldState"""
+        sha1 = hashlib.sha1 ()
+        if len (plan.actual) > 0:
+            # shared with the load of the inputs (OOI.prefetch keeps them)
+            data = OOI.prefetch (self.OOIworldstate.id, sorted (plan.actual), baseUrl=self.OOIworldstate.endpoint)
+            for etpid in sorted (data):
+                sha1.update (json.dumps ([etpid, sorted (data[etpid])]))
+        if len (plan.chain) > 0:
+            # shared with OOI.getDelta of the actual worldstate
+            sha1.update (json.dumps (sorted (OOI.loadWorldstate (self.OOIworldstate.id, sorted (plan.chain), baseUrl=self.OOIworldstate.endpoint))))
+        return sha1.hexdigest ()
+
+    def inputFingerprint (self):
+        """Hash of everything the result depends on or None
+
+        The ICMM WorldState (with its parent chain) and the OOI WorldStates before
+        the actual one are not changed any more, so their URLs stand for the data read
+        from them. The actual OOI WorldState may still change (see isAncestor): the
+        EntityProperties read from it are part of the hash, so an indicator that does
+        not declare its inputs (requires) has no fingerprint.
+        """
+        try:
+            inputs = {
+                'identifier': self.identifier,
+                'code': self.codeVersion (),
+                'requires': self.requires,
+                'worldstateDescription': self.worldstateDescription
+                }
+            if self.hasOOI:
+                plan = self.inputPlan ()
+                if plan is None:
+                    return None
+                inputs['actual'] = self.actualDataHash (plan)
+            return hashlib.sha1 (json.dumps (inputs, sort_keys=True)).hexdigest ()
+        except HTTP.DeadlineExceeded:
+            raise
+        except Exception, e:
+            logging.exception ("inputFingerprint: {0}".format (str(e.args)))
+            return None
+
+    def resultKey (self):
+        return "{0}/{1}/{2}/{3}".format (self.ICMMworldstate.endpoint, self.ICMMworldstate.domain, self.ICMMworldstate.id, self.identifier)
+
+    def storedResult (self, fingerprint):
+        """Result saved by saveResult for the same inputs if it is still the one in ICMM, otherwise None"""
+        if fingerprint is None:
+            return None
+        saved = LocalStore.getStore ().get (resultNamespace, self.resultKey (), touch=True)
+        if (saved is None) or (saved['fingerprint'] != fingerprint):
+            return None
+        result = saved['result']
+        # somebody else may have written the indicator values / KPI since then
+        if 'indicator' in result:
+            if isinstance (result['indicator'], list):
+                values = [(value['id'], value) for value in result['indicator']]
+            else:
+                values = [(self.identifier, result['indicator'])]
+            for (name, value) in values:
+                if self.worldstateSnapshot.getIndicatorValue (name) != value:
+                    logging.info ("stored value of {0} changed in ICMM".format (name))
+                    return None
+        if 'kpi' in result:
+            (kpiURL, kpi) = self.worldstateSnapshot.getKpi ()
+            for (group, entries) in result['kpi'].items ():
+                for (key, entry) in entries.items ():
+                    if (kpi is None) or (kpi.get (group, {}).get (key) != entry):
+                        logging.info ("stored KPI {0}/{1} changed in ICMM".format (group, key))
+                        return None
+        return result
+
+    def saveResult (self, fingerprint):
+        """Remember the fingerprint of the inputs of the result just written to ICMM"""
+        if fingerprint is None:
+            return
+        store = LocalStore.getStore ()
+        store.put (resultNamespace, self.resultKey (), {'fingerprint': fingerprint, 'result': self.result})
+        store.evict (resultNamespace, resultBytes)
+
+    def reuseResult (self, result):
+        """Set the outputs from a stored result instead of calculating it again"""
+        self.result = result
+        if 'indicator' in result:
+            self.indicator.setValue (json.dumps (result['indicator']))
+            if isinstance (result['indicator'], list):
+                # only the last value will be used, sorry
+                if len (result['indicator']) > 0:
+                    self.indicatorRef.setValue (escape (self.worldstateSnapshot.getIndicatorURL (result['indicator'][-1]['id'])))
+            else:
+                self.indicatorRef.setValue (escape (self.worldstateSnapshot.getIndicatorURL (self.identifier)))
+        if 'kpi' in result:
+            self.kpi.setValue (json.dumps (result['kpi']))
+            self.kpiRef.setValue (escape (self.worldstateSnapshot.getKpi ()[0]))
+        self.statusmessage.setValue ("OK, inputs unchanged")
+        self.status.set ("OK, inputs unchanged")
+
+    def loadInputs (self, plan):
+        """Load the inputs of plan, calculateIndicator loads what is missing and reports the problems"""
+        try:
+            plan.load (self)
+        except HTTP.DeadlineExceeded:
+            raise
+        except Exception, e:
+            logging.exception ("load input data: {0}".format (str(e.args)))
+
+    def timeStatus (self):
+        """Start a new phase of the timings with each status.set"""
+        self.phaseTimings = Timings ()
+        statusSet = self.status.set
+        def timedSet (msg="", *args, **kwargs):
+            self.phaseTimings.mark (msg)
+            return statusSet (msg, *args, **kwargs)
+        self.status.set = timedSet
+
+    def reportTimings (self):
+        """timings output and one log line (json) per execution"""
+        timings = self.phaseTimings.result ()
+        timings['identifier'] = self.identifier
+        timings['ICMMworldstateURL'] = self.ICMMworldstateURL.getValue ()
+        self.timings.setValue (json.dumps (timings))
+        logging.info ("timings: {0}".format (json.dumps (timings, sort_keys=True)))
+
+    def isAsynchronous (self):
+        """True if pywps answered the Execute request already (storeExecuteResponse=true&status=true)"""
+        try:
+            responseDocument = self.pywps.inputs["responseform"]["responsedocument"]
+        except (AttributeError, KeyError, TypeError):
+            return False
+        return bool (responseDocument.get ("storeexecuteresponse")) and bool (responseDocument.get ("status"))
+
     def execute(self):
+        self.timeStatus ()
+        HTTP.counters.reset ()
+        # asynchronous executions (storeExecuteResponse=true&status=true) are answered
+        # by pywps with the status location at once; here they wait for a free worker.
+        # Synchronous ones would hold the HTTP connection (and a pywps operation): they fail at once.
+        asynchronous = self.isAsynchronous ()
+        if asynchronous:
+            self.status.set("Waiting for a free worker", 0)
+            worker = acquireWorker ()
+        else:
+            worker = acquireWorker (0)
+        if worker is None:
+            if asynchronous:
+                message = "No free worker within {0} seconds ({1} indicator executions running)".format (workerMaxWait, workers)
+            else:
+                message = "No free worker ({0} indicator executions running), execute asynchronously (storeExecuteResponse=true&status=true) to wait for one".format (workers)
+            logging.error (message)
+            self.statusmessage.setValue (message)
+            self.status.set (message)
+            self.reportTimings ()
+            return message    # pywps: execution failed
+        HTTP.setDeadline (self.timeBudget)
+        try:
+            return self.executeIndicator ()
+        except HTTP.DeadlineExceeded, e:
+            logging.error ("deadline exceeded: {0}".format (e))
+            self.statusmessage.setValue ("Timeout: ICMM / OOI did not answer within {0} seconds".format (self.timeBudget))
+            self.status.set ("Timeout: ICMM / OOI did not answer within {0} seconds".format (self.timeBudget))
+        finally:
+            HTTP.setDeadline (None)
+            worker.close ()
+            self.reportTimings ()
+        return
+
+    def executeIndicator(self):
  
         self.status.set("Check ICMM WorldState status", 1)
 
@@ -150,13 +642,16 @@ class Indicator(WPSProcess):
         logging.info ("ICMMworldstate = {0}".format (self.ICMMworldstate))
         if (self.ICMMworldstate.endpoint is None):
             return "invalid ICMM ref: {0}".format (self.ICMMworldstate)
+        HTTP.counters.setService (self.ICMMworldstate.endpoint, 'ICMM')
         
-        self.worldstateDescription = ICMM.getNameDescription (self.ICMMworldstate.id, baseUrl=self.ICMMworldstate.endpoint)
+        # one request for everything needed from the ICMM WorldState
+        self.worldstateSnapshot = ICMM.WorldstateSnapshot (self.ICMMworldstate.id, baseUrl=self.ICMMworldstate.endpoint)
+        self.worldstateDescription = self.worldstateSnapshot.getNameDescription ()
         self.worldstateDescription["ICMMworldstateURL"] = ICMMworldstateURL
 
         # Not used / available in PilotEv1
         if (self.hasOOI):
-            OOIworldstateURL = ICMM.getOOIRef (self.ICMMworldstate.id, 'OOI-worldstate-ref', baseUrl=self.ICMMworldstate.endpoint)
+            OOIworldstateURL = self.worldstateSnapshot.getOOIRef ('OOI-worldstate-ref')
             logging.info ("OOIworldstateURL = {0}".format (OOIworldstateURL))
             if (OOIworldstateURL is None):
                 return "invalid OOI URL: {0}".format (OOIworldstateURL)
@@ -167,46 +662,84 @@ class Indicator(WPSProcess):
             logging.info ("OOIWorldState = {0}".format (self.OOIworldstate))
             if (self.OOIworldstate.endpoint is None):
                 return "invalid OOI ref: {0}".format (self.OOIworldstate)
+            HTTP.counters.setService (self.OOIworldstate.endpoint, 'OOI')
 
         self.status.set("Check if indicator value already exists", 10)
 
-        indicatorURL = ICMM.getIndicatorURL (self.ICMMworldstate.id, self.identifier, baseUrl=self.ICMMworldstate.endpoint)
+        indicatorURL = self.worldstateSnapshot.getIndicatorURL (self.identifier)
         logging.info ("old indicatorURL = {0}".format (indicatorURL))
         if (indicatorURL is not None):
             logging.info ("Indicator value already exists at: {0}".format (indicatorURL))
 
-        if ((self.doUpdate == 1) or (indicatorURL is None)):
+        # same inputs as the stored result: nothing to calculate
+        fingerprint = self.inputFingerprint ()
+        try:
+            stored = self.storedResult (fingerprint)
+        except Exception, e:
+            logging.exception ("storedResult: {0}".format (str(e.args)))
+            stored = None
+        if stored is not None:
+            logging.info ("inputs unchanged, reuse stored result")
+            self.reuseResult (stored)
+        elif ((self.doUpdate == 1) or (indicatorURL is None)):
+            calculated = False
             try:
-                self.calculateIndicator ()
-                self.statusmessage.setValue ("OK")
+                if self.requires is not None:
+                    self.status.set("Load input data", 15)
+                    self.loadInputs (DataPlan ([self]))
+                error = self.calculateIndicator ()
+                if error is None:
+                    self.statusmessage.setValue ("OK")
+                    calculated = True
+                else:
+                    # e.g. invalid OOI URL: the default result is written, but not kept for reuse
+                    logging.error ("calculateIndicator: {0}".format (error))
 
+            except HTTP.DeadlineExceeded:
+                raise
             except Exception, e:
                 logging.exception ("calculateIndicator: {0}".format (str(e.args)))
                 self.statusmessage.setValue ("calculateIndicator: {0}".format (str(e.args)))
                 self.status.set("save result: {0}".format (str(e.args)))
 
             try:
+                # indicator values (worldstatedata) and kpi (iccdata) are independent: write them at the same time
+                indicatorWrite = None
+                kpiWrite = None
                 if 'indicator' in self.result:
                     logging.info ("indicatorData: {0}".format (json.dumps (self.result['indicator'])))
                     self.indicator.setValue (json.dumps (self.result['indicator']))
                     if isinstance(self.result['indicator'], list):
-                        for x in self.result['indicator']:
-                            ICMMindicatorValueURL = ICMM.addIndicatorValToICMM (self.ICMMworldstate.id, x['id'], x['name'], x, self.ICMMworldstate.endpoint)
-                            # only the last value will be used, sorry
-                            self.indicatorRef.setValue(escape (ICMMindicatorValueURL))
+                        # all values with one worldstate update
+                        values = [(x['id'], x['name'], x) for x in self.result['indicator']]
+                        indicatorWrite = ThreadPool.submit (ICMM.addIndicatorValuesToICMM, self.ICMMworldstate.id, values, self.ICMMworldstate.endpoint, snapshot=self.worldstateSnapshot)
                     if isinstance(self.result['indicator'], dict):
-                        ICMMindicatorValueURL = ICMM.addIndicatorValToICMM (self.ICMMworldstate.id, self.identifier, self.title, self.result['indicator'], self.ICMMworldstate.endpoint)
-                        self.indicatorRef.setValue(escape (ICMMindicatorValueURL))
+                        indicatorWrite = ThreadPool.submit (ICMM.addIndicatorValToICMM, self.ICMMworldstate.id, self.identifier, self.title, self.result['indicator'], self.ICMMworldstate.endpoint, snapshot=self.worldstateSnapshot)
 
                 if 'kpi' in self.result:
                     logging.info ("kpiData: {0}".format (json.dumps (self.result['kpi'])))
                     self.kpi.setValue (json.dumps (self.result['kpi']))
-                    ICMMkpiValueURL = ICMM.addKpiValToICMM (self.ICMMworldstate.id, self.identifier, self.title, self.result['kpi'], self.ICMMworldstate.endpoint)
-                    self.kpiRef.setValue(escape (ICMMkpiValueURL))
+                    kpiWrite = ThreadPool.submit (ICMM.addKpiValToICMM, self.ICMMworldstate.id, self.identifier, self.title, self.result['kpi'], self.ICMMworldstate.endpoint, snapshot=self.worldstateSnapshot)
+
+                ThreadPool.wait ([f for f in [indicatorWrite, kpiWrite] if f is not None])
+                if indicatorWrite is not None:
+                    if isinstance(self.result['indicator'], list):
+                        ICMMindicatorValueURLs = indicatorWrite.result ()
+                        # only the last value will be used, sorry
+                        if len (ICMMindicatorValueURLs) > 0:
+                            self.indicatorRef.setValue(escape (ICMMindicatorValueURLs[-1]))
+                    else:
+                        self.indicatorRef.setValue(escape (indicatorWrite.result ()))
+                if kpiWrite is not None:
+                    self.kpiRef.setValue(escape (kpiWrite.result ()))
 
                 self.statusmessage.setValue ("OK")
                 self.status.set ("OK")
+                if calculated:
+                    self.saveResult (fingerprint)
                 
+            except HTTP.DeadlineExceeded:
+                raise
             except Exception, e:
                 logging.exception ("save result: {0}".format (str(e.args)))
                 self.statusmessage.setValue ("save result: {0}".format (str(e.args)))
@@ -215,5 +748,6 @@ class Indicator(WPSProcess):
             self.statusmessage.setValue ("OK, indicator already exists")
             self.status.set ("OK, indicator already exists")
 
+        logging.info ("HTTP cache: {0}".format (HTTP.cache.stats ()))
         return
 
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# Incremental JSON parsing
+#
+# parse (chunks) reads a JSON document piece by piece (e.g. from
+# response.iter_content ()) and yields events while reading, so a caller can
+# pick the values it needs from a large document and stop reading early.
+# The events are the same as those of ijson.parse:
+#   (prefix, event, value)
+#   prefix: dot separated path, 'item' for array elements, e.g. 'parentworldstate.categories.item.key'
+#   event:  start_map, map_key, end_map, start_array, end_array, string, number, boolean, null
+# events (chunks) yields the same without the prefix, (event, key, value),
+# so the cost per event does not depend on the nesting depth.
+# ijson is used if it is installed, otherwise a pure python parser.
+
+import json
+import re
+import decimal
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+class ChunkReader:
+    """File like object reading from an iterator of strings (as needed by ijson)"""
+    def __init__ (self, chunks):
+        self.chunks = iter (chunks)
+        self.buffer = ''
+
+    def read (self, size=-1):
+        while (size < 0) or (len (self.buffer) < size):
+            try:
+                self.buffer += next (self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len (self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+
+tokenPattern = re.compile (r'\s*(?:([{}\[\]:,])|("(?:[^"\\]|\\.)*")|(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)|(true|false|null))')
+
+def tokens (chunks):
+    """Yield (kind, value) of the JSON tokens: kind is 'punct', 'string', 'number' or 'literal'"""
+    buffer = ''
+    position = 0
+    eof = False
+    chunks = iter (chunks)
+    while True:
+        match = tokenPattern.match (buffer, position)
+        # a token touching the end of the buffer may continue in the next chunk (e.g. number 1.5 of 1.5e3)
+        if ((match is None) or (match.end () == len (buffer)) or ((match.group (3) is not None) and (buffer[match.end ()] in '0123456789.eE+-'))) and not eof:
+            try:
+                buffer = buffer[position:] + next (chunks)
+                position = 0
+            except StopIteration:
+                eof = True
+            continue
+        if match is None:
+            if buffer[position:].strip () != '':
+                raise ValueError ("Invalid JSON at: {0}".format (buffer[position:position+40]))
+            return
+        position = match.end ()
+        if match.group (1) is not None:
+            yield ('punct', match.group (1))
+        elif match.group (2) is not None:
+            yield ('string', json.loads (match.group (2)))
+        elif match.group (3) is not None:
+            number = match.group (3)
+            yield ('number', float (number) if re.search (r'[.eE]', number) else int (number))
+        else:
+            yield ('literal', {'true': True, 'false': False, 'null': None}[match.group (4)])
+
+
+def parsePython (chunks):
+    """parse implemented without ijson"""
+    path = []          # one element for each open container: key (map) or 'item' (array)
+    maps = []          # for each open container: True if it is a map
+    expectKey = False
+    for (kind, value) in tokens (chunks):
+        if kind == 'punct':
+            if (value == '{') or (value == '['):
+                yield ('.'.join (path), 'start_map' if value == '{' else 'start_array', None)
+                maps.append (value == '{')
+                path.append (None if value == '{' else 'item')
+                expectKey = (value == '{')
+            elif (value == '}') or (value == ']'):
+                maps.pop ()
+                path.pop ()
+                expectKey = False
+                yield ('.'.join (path), 'end_map' if value == '}' else 'end_array', None)
+            elif value == ',':
+                expectKey = maps[-1]
+        elif (kind == 'string') and expectKey:
+            path[-1] = value
+            expectKey = False
+            yield ('.'.join (path[:-1]), 'map_key', value)
+        elif kind == 'string':
+            yield ('.'.join (path), 'string', value)
+        elif kind == 'number':
+            yield ('.'.join (path), 'number', value)
+        elif value is None:
+            yield ('.'.join (path), 'null', None)
+        else:
+            yield ('.'.join (path), 'boolean', value)
+
+
+def eventsPython (chunks):
+    """events implemented without ijson"""
+    maps = []          # for each open container: True if it is a map
+    key = None
+    expectKey = False
+    for (kind, value) in tokens (chunks):
+        if kind == 'punct':
+            if (value == '{') or (value == '['):
+                yield ('start_map' if value == '{' else 'start_array', key, None)
+                maps.append (value == '{')
+                key = None
+                expectKey = (value == '{')
+            elif (value == '}') or (value == ']'):
+                maps.pop ()
+                key = None
+                expectKey = False
+                yield ('end_map' if value == '}' else 'end_array', None, None)
+            elif value == ',':
+                key = None
+                expectKey = maps[-1]
+        elif (kind == 'string') and expectKey:
+            key = value
+            expectKey = False
+        elif kind == 'number':
+            yield ('number', key, value)
+        elif kind == 'string':
+            yield ('string', key, value)
+        elif value is None:
+            yield ('null', key, None)
+        else:
+            yield ('boolean', key, value)
+
+
+def eventsIjson (chunks):
+    key = None
+    for (event, value) in ijson.basic_parse (ChunkReader (chunks)):
+        if event == 'map_key':
+            key = value
+            continue
+        if isinstance (value, decimal.Decimal):
+            value = float (value)     # like json.loads
+        if (event == 'end_map') or (event == 'end_array'):
+            yield (event, None, None)
+        else:
+            yield (event, key, value)
+        key = None
+
+
+def events (chunks):
+    """Yield (event, key, value) for the JSON document given as iterator of strings
+
+    key: map key of the value (None for array elements and end events)
+    event: as in parse, without map_key
+    """
+    if ijson is not None:
+        return eventsIjson (chunks)
+    return eventsPython (chunks)
+
+
+def parseIjson (chunks):
+    for (prefix, event, value) in ijson.parse (ChunkReader (chunks)):
+        if isinstance (value, decimal.Decimal):
+            value = float (value)     # like json.loads
+        yield (prefix, event, value)
+
+
+def parse (chunks):
+    """Yield (prefix, event, value) for the JSON document given as iterator of strings"""
+    if ijson is not None:
+        return parseIjson (chunks)
+    return parsePython (chunks)
+
+
+whitespace = re.compile (r'\s*')
+decoder = json.JSONDecoder ()
+
+def listItems (chunks):
+    """Yield the elements of a top level JSON list
+
+    Each element is decoded by the json module as soon as it is read completely.
+    """
+    chunks = iter (chunks)
+    buffer = ''
+    position = 0
+    eof = False
+    started = False
+    while True:
+        position = whitespace.match (buffer, position).end ()
+        if position < len (buffer):
+            c = buffer[position]
+            if not started:
+                if c != '[':
+                    raise ValueError ("JSON list expected at: {0}".format (buffer[position:position+40]))
+                started = True
+                position += 1
+                continue
+            if c == ']':
+                return
+            if c == ',':
+                position += 1
+                continue
+            try:
+                (value, end) = decoder.raw_decode (buffer, position)
+                # a number at the end of the buffer may continue in the next chunk (e.g. 1.5 of 1.5e3)
+                if eof or ((end < len (buffer)) and (buffer[end] not in '0123456789.eE+-')):
+                    yield value
+                    position = end
+                    continue
+            except ValueError:
+                if eof:
+                    raise
+        elif eof:
+            if started:
+                raise ValueError ("Incomplete JSON list")
+            return
+        # need more data
+        try:
+            buffer = buffer[position:] + next (chunks)
+            position = 0
+        except StopIteration:
+            eof = True
+
+
+def items (chunks, prefix):
+    """Yield the values at prefix (like ijson.items), e.g. prefix 'item' for the elements of a top level list
+
+    Only one value is in memory at a time.
+    """
+    if prefix == 'item':
+        for value in listItems (chunks):
+            yield value
+        return
+    stack = []         # values under construction
+    keys = []          # actual key of each map in stack
+    for (path, event, value) in parse (chunks):
+        if len (stack) == 0:
+            if path != prefix:
+                continue
+            if event == 'start_map':
+                stack.append ({})
+                keys.append (None)
+            elif event == 'start_array':
+                stack.append ([])
+                keys.append (None)
+            elif event not in ['map_key', 'end_map', 'end_array']:
+                yield value
+            continue
+        if event == 'map_key':
+            keys[-1] = value
+            continue
+        if (event == 'end_map') or (event == 'end_array'):
+            value = stack.pop ()
+            keys.pop ()
+            if len (stack) == 0:
+                yield value
+            # a nested container is already in its parent (added at its start)
+            continue
+        elif (event == 'start_map') or (event == 'start_array'):
+            value = {} if event == 'start_map' else []
+        if isinstance (stack[-1], list):
+            stack[-1].append (value)
+        else:
+            stack[-1][keys[-1]] = value
+        if (event == 'start_map') or (event == 'start_array'):
+            stack.append (value)
+            keys.append (None)
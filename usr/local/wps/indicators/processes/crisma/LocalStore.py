@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Local persistent store shared by all pywps processes on this host
+#
+# Small json values are kept in one sqlite database, addressed by
+# (namespace, key). sqlite does the locking, so many CGI processes can
+# read and update the same values at the same time.
+# The store is an optimization only: if it can not be used, get returns
+# None and put/update do nothing except logging the problem.
+
+######################
+#  Configuration
+defaultPath = '/tmp/crisma-indicators.sqlite'
+timeout = 30              # seconds to wait for a lock held by another process
+#####################
+
+import sqlite3
+import threading
+import json
+import zlib
+import time
+import os
+import logging
+
+
+class LocalStore:
+    def __init__ (self, path=defaultPath):
+        self.path = path
+        self.local = threading.local ()
+
+    def __repr__ (self):
+        return "LocalStore {0}".format (self.path)
+
+    def connection (self):
+        """sqlite connection of the actual thread (connections must not be shared between threads)"""
+        db = getattr (self.local, 'db', None)
+        if db is None:
+            # isolation_level=None: no implicit transactions, see update()
+            db = sqlite3.connect (self.path, timeout=timeout, isolation_level=None)
+            db.execute ("CREATE TABLE IF NOT EXISTS store (namespace TEXT, key TEXT, value BLOB, size INTEGER, created REAL, accessed REAL, PRIMARY KEY (namespace, key))")
+            try:
+                os.chmod (self.path, 0666)   # shared by all users running pywps
+            except OSError:
+                pass
+            self.local.db = db
+        return db
+
+    def encode (self, value):
+        return sqlite3.Binary (zlib.compress (json.dumps (value)))
+
+    def decode (self, data):
+        return json.loads (zlib.decompress (str (data)))
+
+    def get (self, namespace, key, maxAge=None, touch=False):
+        """Get a value or None if there is no such value (or it is older than maxAge seconds)
+
+        touch: note the access for evict
+        """
+        try:
+            db = self.connection ()
+            row = db.execute ("SELECT value, created FROM store WHERE namespace=? AND key=?", (namespace, key)).fetchone ()
+            if row is None:
+                return None
+            if (maxAge is not None) and (row[1] + maxAge < time.time ()):
+                return None
+            if touch:
+                db.execute ("UPDATE store SET accessed=? WHERE namespace=? AND key=?", (time.time (), namespace, key))
+            return self.decode (row[0])
+        except Exception, e:
+            logging.warning ("{0}: get {1}/{2} failed: {3}".format (self, namespace, key, e))
+            return None
+
+    def getRaw (self, namespace, key, touch=False):
+        """Get the stored data (zlib compressed JSON text) without decoding it, or None"""
+        try:
+            db = self.connection ()
+            row = db.execute ("SELECT value FROM store WHERE namespace=? AND key=?", (namespace, key)).fetchone ()
+            if row is None:
+                return None
+            if touch:
+                db.execute ("UPDATE store SET accessed=? WHERE namespace=? AND key=?", (time.time (), namespace, key))
+            return str (row[0])
+        except Exception, e:
+            logging.warning ("{0}: getRaw {1}/{2} failed: {3}".format (self, namespace, key, e))
+            return None
+
+    def items (self, namespace):
+        """All (key, value) of the namespace"""
+        try:
+            rows = self.connection ().execute ("SELECT key, value FROM store WHERE namespace=?", (namespace,)).fetchall ()
+            return [(row[0], self.decode (row[1])) for row in rows]
+        except Exception, e:
+            logging.warning ("{0}: items {1} failed: {2}".format (self, namespace, e))
+            return []
+
+    def put (self, namespace, key, value):
+        try:
+            data = self.encode (value)
+            now = time.time ()
+            self.connection ().execute ("INSERT OR REPLACE INTO store (namespace, key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)", (namespace, key, data, len (data), now, now))
+        except Exception, e:
+            logging.warning ("{0}: put {1}/{2} failed: {3}".format (self, namespace, key, e))
+
+    def putRaw (self, namespace, key, data):
+        """Store data already encoded: zlib compressed JSON text, e.g. a compressed HTTP response"""
+        try:
+            now = time.time ()
+            self.connection ().execute ("INSERT OR REPLACE INTO store (namespace, key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)", (namespace, key, sqlite3.Binary (data), len (data), now, now))
+        except Exception, e:
+            logging.warning ("{0}: putRaw {1}/{2} failed: {3}".format (self, namespace, key, e))
+
+    def delete (self, namespace, key):
+        try:
+            self.connection ().execute ("DELETE FROM store WHERE namespace=? AND key=?", (namespace, key))
+        except Exception, e:
+            logging.warning ("{0}: delete {1}/{2} failed: {3}".format (self, namespace, key, e))
+
+    def evict (self, namespace, maxBytes):
+        """Delete the least recently used values of the namespace until it uses at most maxBytes"""
+        try:
+            db = self.connection ()
+            db.execute ("BEGIN IMMEDIATE")
+            try:
+                total = db.execute ("SELECT SUM(size) FROM store WHERE namespace=?", (namespace,)).fetchone ()[0] or 0
+                if total > maxBytes:
+                    for (key, size) in db.execute ("SELECT key, size FROM store WHERE namespace=? ORDER BY accessed", (namespace,)).fetchall ():
+                        db.execute ("DELETE FROM store WHERE namespace=? AND key=?", (namespace, key))
+                        total -= size
+                        if total <= maxBytes:
+                            break
+                db.execute ("COMMIT")
+            except:
+                db.execute ("ROLLBACK")
+                raise
+        except sqlite3.Error, e:
+            logging.warning ("{0}: evict {1} failed: {2}".format (self, namespace, e))
+
+    def update (self, namespace, key, function):
+        """Atomic read-modify-write: value = function (old value or None)
+
+        No other process can change the value in between.
+
+        returns the new value or None if the store is not usable
+        """
+        try:
+            db = self.connection ()
+            db.execute ("BEGIN IMMEDIATE")
+            try:
+                row = db.execute ("SELECT value FROM store WHERE namespace=? AND key=?", (namespace, key)).fetchone ()
+                value = function (None if row is None else self.decode (row[0]))
+                data = self.encode (value)
+                now = time.time ()
+                db.execute ("INSERT OR REPLACE INTO store (namespace, key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)", (namespace, key, data, len (data), now, now))
+                db.execute ("COMMIT")
+                return value
+            except:
+                db.execute ("ROLLBACK")
+                raise
+        except sqlite3.Error, e:
+            logging.warning ("{0}: update {1}/{2} failed: {3}".format (self, namespace, key, e))
+            return None
+
+
+_store = None
+
+def getStore ():
+    """The store of this process"""
+    global _store
+    if _store is None:
+        _store = LocalStore ()
+    return _store
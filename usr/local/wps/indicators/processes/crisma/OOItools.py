@@ -8,6 +8,13 @@
 ######################
 #  Configuration
 defaultBaseUrl = 'http://crisma-ooi.ait.ac.at/api'
+prefetchAllThreshold = 3       # load all EntityProperties of a worldstate if at least this many etpids are needed
+etpidListSupported = False     # OOI-WSR accepts etpid=1,2,3 in one request
+cacheBytes = 256 * 1024 * 1024 # disk space for cached OOI-WSR responses (LocalStore)
+baselineBytes = 16 * 1024 * 1024  # disk space for the Baselines of the exercises (LocalStore)
+bulkStoreSupported = False     # OOI-WSR accepts a list of EntityProperties in one POST / PUT
+deltaParam = None              # OOI-WSR query parameter for the EntityProperties changed since another worldstate, None: not supported
+                               # (removed ones are reported with "removed": true)
 #####################
 
 
@@ -24,12 +31,25 @@ indicatorEntityId = 101
 
 
 import json
-import requests
+import urllib
+import HTTPtools as HTTP
 import re
 import time
 import math
+import threading
 import logging
 
+import zlib
+import ThreadPool
+import LocalStore
+import JSONstream
+
+try:
+    import numpy
+    numpy.seterr (invalid='ignore')   # comparing nan (not a number) is expected
+except ImportError:
+    numpy = None
+
 class OOIAccess:
     def __init__ (self, url):
         """crunch OOI-WSR URL into endpoint, resource, id
@@ -55,8 +75,30 @@ class OOIAccess:
     def __repr__ (self):
         return "endpoint={0}, resource={1}, id={2}".format (self.endpoint, self.resource, self.id)
 
-def getJson (url, params=None, headers={'content-type': 'application/json'}):
-    entityProperties = requests.get(url, params=params, headers=headers) 
+cacheNamespace = 'OOI-WSR'
+
+def cacheKey (url, params):
+    if not params:
+        return url
+    return "{0}?{1}".format (url, urllib.urlencode (sorted (params.items ())))
+
+def getJson (url, params=None, headers={'content-type': 'application/json'}, cached=False):
+    """GET from OOI-WSR
+
+    OOI worldstates do not change once the simulation has moved on to a child
+    worldstate, so their responses are kept in the LocalStore
+    (shared by all processes, least recently used are removed above cacheBytes).
+    cached: True for the worldstates before the current one (parents, Baseline) only;
+            the current worldstate may still change, as may data changed by us, e.g. indicator values
+    """
+    if cached:
+        key = cacheKey (url, params)
+        jsonData = LocalStore.getStore ().get (cacheNamespace, key, touch=True)
+        if jsonData is not None:
+            if isinstance (jsonData, list):
+                HTTP.counters.add (url, 'records', len (jsonData))
+            return jsonData
+    entityProperties = HTTP.get (url, params=params, headers=headers) 
     if entityProperties.status_code != 200:
         raise Exception ("Error accessing OOI-WSR at {0}: {1}".format (urllib.quote (entityProperties.url), entityProperties.status_code))
     if entityProperties.text is None:
@@ -64,9 +106,474 @@ def getJson (url, params=None, headers={'content-type': 'application/json'}):
     if entityProperties.text == "":
         raise Exception ("Error accessing OOI-WSR at {0}: {1}".format (urllib.quote (entityProperties.url), "No such entityProperties"))
     jsonData = entityProperties.json() if callable (entityProperties.json) else entityProperties.json
+    if isinstance (jsonData, list):
+        HTTP.counters.add (url, 'records', len (jsonData))
+    if cached:
+        store = LocalStore.getStore ()
+        store.put (cacheNamespace, key, jsonData)
+        store.evict (cacheNamespace, cacheBytes)
     return jsonData
 
 
+def iterJson (url, params=None, headers={'content-type': 'application/json'}, cached=False):
+    """Like getJson for a list (e.g. all EntityProperties of a worldstate), but yields
+    the elements while the response is read, so only the elements kept by the caller are in memory
+
+    The cache is shared with getJson: the response is compressed while it is read
+    and stored when it was read completely.
+    """
+    store = LocalStore.getStore ()
+    key = cacheKey (url, params)
+    data = store.getRaw (cacheNamespace, key, touch=True) if cached else None
+    records = 0
+    if data is not None:
+        try:
+            for item in JSONstream.items (decompressChunks (data), 'item'):
+                records += 1
+                yield item
+        finally:
+            HTTP.counters.add (url, 'records', records)
+        return
+    response = HTTP.getStream (url, params=params, headers=headers)
+    try:
+        if response.status_code != 200:
+            raise Exception ("Error accessing OOI-WSR at {0}: {1}".format (urllib.quote (response.url), response.status_code))
+        # only a response to be cached is kept (compressed) while it is read
+        compressor = zlib.compressobj () if cached else None
+        compressed = []
+        received = [0]
+        def chunks ():
+            for chunk in response.iter_content (HTTP.chunkSize):
+                received[0] += len (chunk)
+                if compressor is not None:
+                    compressed.append (compressor.compress (chunk))
+                yield chunk
+        for item in JSONstream.items (chunks (), 'item'):
+            records += 1
+            yield item
+        if received[0] == 0:
+            raise Exception ("Error accessing OOI-WSR at {0}: {1}".format (urllib.quote (response.url), "No such entityProperties"))
+        if cached:
+            compressed.append (compressor.flush ())
+            store.putRaw (cacheNamespace, key, ''.join (compressed))
+            store.evict (cacheNamespace, cacheBytes)
+    finally:
+        HTTP.counters.add (url, 'records', records)
+        if hasattr (response, 'close'):   # not in old requests versions
+            response.close ()
+
+def decompressChunks (data):
+    decompressor = zlib.decompressobj ()
+    for start in range (0, len (data), HTTP.chunkSize):
+        yield decompressor.decompress (data[start:start + HTTP.chunkSize])
+    yield decompressor.flush ()
+
+
+# etpid -> entityTypeProperty (type metadata), one object for all EntityProperties of this etpid
+entityTypeProperties = {}
+
+class EntityPropertyRecord (tuple):
+    """Compact EntityProperty: (entityId, entityTypePropertyId, entityTypePropertyType, entityPropertyValue)
+
+    Read like the JSON dict: ep["entityId"], ep.get ("entityPropertyValue"), ep["entityTypeProperty"]
+    (the type metadata shared by all EntityProperties of the etpid).
+    Keys with null values are missing (as with omitNullValues).
+    JSON: list of the 4 values, EntityPropertyRecord (list) restores it.
+    """
+    __slots__ = ()
+    fields = {'entityId': 0, 'entityTypePropertyId': 1, 'entityPropertyValue': 3}
+
+    def __getitem__ (self, key):
+        if key == 'entityTypeProperty':
+            entityTypeProperty = entityTypeProperties.get (tuple.__getitem__ (self, 1))
+            if entityTypeProperty is None:
+                # restored from JSON: only the type is known
+                entityTypeProperty = {'entityTypePropertyType': tuple.__getitem__ (self, 2)}
+            return entityTypeProperty
+        if isinstance (key, basestring):
+            return tuple.__getitem__ (self, self.fields[key])
+        return tuple.__getitem__ (self, key)
+
+    def get (self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __contains__ (self, key):
+        return self.get (key) is not None
+
+    def asDict (self):
+        return {
+            "entityId": self[0],
+            "entityTypePropertyId": self[1],
+            "entityTypeProperty": self["entityTypeProperty"],
+            "entityPropertyValue": self[3]
+            }
+
+def compact (ep):
+    """EntityPropertyRecord of an EntityProperty (JSON dict)"""
+    etpid = ep.get ("entityTypePropertyId", -1)
+    entityTypeProperty = ep.get ("entityTypeProperty") or {}
+    if etpid not in entityTypeProperties:
+        entityTypeProperties.setdefault (etpid, entityTypeProperty)
+    return EntityPropertyRecord ((ep.get ("entityId"), etpid, entityTypeProperty.get ('entityTypePropertyType', -1), ep.get ("entityPropertyValue")))
+
+
+# (baseUrl, wsid, etpids) -> ThreadPool.Future of [EntityPropertyRecord], see loadWorldstate
+worldstates = {}
+worldstatesLock = threading.Lock ()
+
+def loadWorldstate (wsid, etpids=None, baseUrl=defaultBaseUrl, cached=False):
+    """EntityProperties of the given etpids (None: all) of a worldstate, loaded once per process
+
+    Few etpids are filtered by OOI-WSR (etpid parameter), otherwise the whole
+    worldstate is read and the EntityProperties not needed are dropped while reading.
+    A worldstate loaded by another thread at the same time is waited for,
+    as is a load of more etpids of it.
+
+    returns [EntityPropertyRecord]
+    """
+    key = (baseUrl, wsid, None if etpids is None else tuple (sorted (set (etpids))))
+    superset = None
+    with worldstatesLock:
+        future = worldstates.get (key)
+        first = future is None
+        if first:
+            for ((loadedUrl, loadedWsid, loadedEtpids), loaded) in worldstates.items ():
+                if (loadedUrl, loadedWsid) == (baseUrl, wsid) and ((loadedEtpids is None) or ((etpids is not None) and set (etpids) <= set (loadedEtpids))):
+                    superset = loaded
+                    break
+            else:
+                future = worldstates[key] = ThreadPool.Future ()
+    if superset is not None:
+        wanted = set (key[2] or [])
+        return [ep for ep in superset.result () if (etpids is None) or (ep["entityTypePropertyId"] in wanted)]
+    if first:
+        future.run (readWorldstate, (wsid, key[2], baseUrl, cached), {})
+    return future.result ()
+
+def readWorldstate (wsid, etpids, baseUrl, cached):
+    url = "{0}/EntityProperty".format (baseUrl)
+    if (etpids is None) or (len (etpids) >= prefetchAllThreshold):
+        wanted = None if etpids is None else set (etpids)
+        return [compact (ep) for ep in iterJson (url, params={'wsid': wsid}, cached=cached) if (wanted is None) or (ep["entityTypePropertyId"] in wanted)]
+    if etpidListSupported and (len (etpids) > 1):
+        return [compact (ep) for ep in getJson (url, params={'wsid': wsid, 'etpid': ",".join (str (etpid) for etpid in etpids)}, cached=cached)]
+    loads = [ThreadPool.submit (getJson, url, params={'wsid': wsid, 'etpid': etpid}, cached=cached) for etpid in etpids]
+    return [compact (ep) for result in ThreadPool.wait (loads) for ep in result]
+
+def getDelta (wsid, parentWsid, etpids=None, baseUrl=defaultBaseUrl, cached=False):
+    """Changes of worldstate wsid against worldstate parentWsid
+
+    If OOI-WSR supports it (deltaParam) only the changes are transferred.
+    Otherwise both worldstates are loaded (see loadWorldstate, the parent
+    usually from the cache) and compared here.
+
+    wsid, parentWsid: OOI-specific WorldState ids, parentWsid None: all EntityProperties
+    etpids: EntityTypeProperty ids to return, None: all
+    cached: wsid is not the current worldstate any more, see getJson
+
+    returns ([EntityPropertyRecord new or changed], [(entityId, entityTypePropertyId) removed])
+    """
+    if etpids is None:
+        wanted = lambda ep: True
+    else:
+        wanted = lambda ep: ep["entityTypePropertyId"] in etpids
+    if (parentWsid is not None) and (deltaParam is not None):
+        url = "{0}/EntityProperty".format (baseUrl)
+        changed = []
+        removed = []
+        for ep in iterJson (url, params={'wsid': wsid, deltaParam: parentWsid}, cached=cached):
+            if not wanted (ep):
+                continue
+            if ep.get ("removed"):
+                removed.append ((ep.get ("entityId"), ep.get ("entityTypePropertyId")))
+            else:
+                changed.append (compact (ep))
+        return (changed, removed)
+    records = loadWorldstate (wsid, etpids, baseUrl=baseUrl, cached=cached)
+    if parentWsid is None:
+        return (records, [])
+    # the parent is never the current worldstate
+    # (entityId, entityTypePropertyId) -> value in parent
+    parentValues = dict (((ep[0], ep[1]), ep[3]) for ep in loadWorldstate (parentWsid, etpids, baseUrl=baseUrl, cached=True))
+    missing = object ()
+    changed = [ep for ep in records if parentValues.get ((ep[0], ep[1]), missing) != ep[3]]
+    present = set ((ep[0], ep[1]) for ep in records)
+    removed = [key for key in parentValues if key not in present]
+    return (changed, removed)
+
+
+# (baseUrl, wsid) -> {etpid: [EntityPropertyRecord, ...], 'all': True if all etpids are loaded}
+entityProperties = {}
+entityPropertiesLock = threading.Lock ()
+
+def prefetch (wsid, etpids, baseUrl=defaultBaseUrl, cached=False):
+    """Load the EntityProperties of several etpids of a worldstate with as few requests as possible
+
+    The result is kept for this process, so indicators using the same properties share one load.
+
+    wsid: OOI-specific WorldState id
+    etpids: EntityTypeProperty ids
+    cached: wsid is not the current worldstate any more, see getJson
+
+    returns {etpid: [EntityPropertyRecord, ...]}
+    """
+    key = (baseUrl, wsid)
+    with entityPropertiesLock:
+        known = entityProperties.setdefault (key, {})
+        missing = [etpid for etpid in set (etpids) if (etpid not in known) and not known.get ('all')]
+    url = "{0}/EntityProperty".format (baseUrl)
+    loaded = {}
+    if len (missing) == 0:
+        pass
+    elif len (missing) >= prefetchAllThreshold:
+        # one request for the whole worldstate
+        for ep in iterJson (url, params={'wsid': wsid}, cached=cached):
+            loaded.setdefault (ep['entityTypePropertyId'], []).append (compact (ep))
+        loaded['all'] = True
+    elif etpidListSupported and (len (missing) > 1):
+        for ep in getJson (url, params={'wsid': wsid, 'etpid': ",".join (str (etpid) for etpid in sorted (missing))}, cached=cached):
+            loaded.setdefault (ep['entityTypePropertyId'], []).append (compact (ep))
+    else:
+        # one request per etpid, at the same time
+        loads = [(etpid, ThreadPool.submit (getJson, url, params={'wsid': wsid, 'etpid': etpid}, cached=cached)) for etpid in missing]
+        ThreadPool.wait ([load for (etpid, load) in loads])
+        for (etpid, load) in loads:
+            loaded[etpid] = [compact (ep) for ep in load.result ()]
+    with entityPropertiesLock:
+        known.update (loaded)
+        for etpid in missing:
+            known.setdefault (etpid, [])
+        return dict ((etpid, known.get (etpid, [])) for etpid in etpids)
+
+def getEntityProperties (wsid, etpid, baseUrl=defaultBaseUrl, cached=False):
+    """EntityProperties of one etpid of a worldstate, see prefetch"""
+    return prefetch (wsid, [etpid], baseUrl=baseUrl, cached=cached)[etpid]
+
+
+class Vector:
+    """Minimal replacement for a one-dimensional numpy array if numpy is not installed
+
+    Supports what PropertyTable users need: element wise comparison and
+    arithmetic with scalars or vectors, & | ~ on masks, v[mask], sum ()
+    """
+    def __init__ (self, items):
+        self.items = list (items)
+
+    def __len__ (self):
+        return len (self.items)
+
+    def __iter__ (self):
+        return iter (self.items)
+
+    def __repr__ (self):
+        return "Vector {0}".format (self.items)
+
+    def __getitem__ (self, index):
+        if isinstance (index, Vector):
+            return Vector (x for (x, m) in zip (self.items, index.items) if m)
+        return self.items[index]
+
+    def apply (self, other, function):
+        if isinstance (other, Vector):
+            return Vector (function (x, y) for (x, y) in zip (self.items, other.items))
+        return Vector (function (x, other) for x in self.items)
+
+    def __lt__ (self, other): return self.apply (other, lambda x, y: x < y)
+    def __le__ (self, other): return self.apply (other, lambda x, y: x <= y)
+    def __gt__ (self, other): return self.apply (other, lambda x, y: x > y)
+    def __ge__ (self, other): return self.apply (other, lambda x, y: x >= y)
+    def __eq__ (self, other): return self.apply (other, lambda x, y: x == y)
+    def __ne__ (self, other): return self.apply (other, lambda x, y: x != y)
+    def __add__ (self, other): return self.apply (other, lambda x, y: x + y)
+    def __sub__ (self, other): return self.apply (other, lambda x, y: x - y)
+    def __and__ (self, other): return self.apply (other, lambda x, y: x and y)
+    def __or__ (self, other): return self.apply (other, lambda x, y: x or y)
+
+    def __invert__ (self):
+        return Vector (not x for x in self.items)
+
+    def sum (self):
+        return sum (self.items)
+
+
+def column (items, dtype):
+    """numpy array if available, Vector otherwise"""
+    if numpy is not None:
+        return numpy.array (list (items), dtype=dtype)
+    return Vector (items)
+
+
+def parseNumbers (strings):
+    """Parse numbers with "," or "." as decimal separator
+
+    returns (numbers, valid): numbers is nan where valid is False
+    """
+    strings = [s if isinstance (s, basestring) else '' for s in strings]
+    # one replace for all values instead of one per value
+    parts = u"\x00".join (strings).replace (",", ".").split (u"\x00")
+    if len (parts) != len (strings):
+        parts = [s.replace (",", ".") for s in strings]
+    if numpy is not None:
+        try:
+            # all values are numbers: parsed at once
+            return (numpy.array (parts, dtype=float), numpy.ones (len (parts), dtype=bool))
+        except ValueError:
+            pass
+    numbers = []
+    valid = []
+    for part in parts:
+        try:
+            numbers.append (float (part))
+            valid.append (True)
+        except ValueError:
+            numbers.append (float ('nan'))
+            valid.append (False)
+    return (column (numbers, float), column (valid, bool))
+
+
+class PropertyTable:
+    """EntityProperties as columns
+
+    entityIds, etpids, types (entityTypePropertyType, -1 if unknown),
+    values (raw strings), numbers (parsed values, nan if not a number), valid (value is a number)
+
+    The columns are numpy arrays (or Vector without numpy), so counts and
+    thresholds are done for all rows at once, e.g.
+      patients = table.select ((table.types == 1) & table.valid)
+      dead = int ((patients.numbers < 20).sum ())
+    """
+    def __init__ (self, entityProperties=None, columns=None):
+        if columns is not None:
+            (self.entityIds, self.etpids, self.types, self.values, self.numbers, self.valid) = columns
+            return
+        entityProperties = entityProperties or []
+        if (len (entityProperties) > 0) and isinstance (entityProperties[0], EntityPropertyRecord):
+            # the columns are the fields of the records
+            (entityIds, etpids, types, values) = zip (*entityProperties)
+            self.entityIds = column (entityIds, int)
+            self.etpids = column (etpids, int)
+            self.types = column (types, int)
+            self.values = column (values, object)
+        else:
+            self.entityIds = column ((ep.get ('entityId') for ep in entityProperties), int)
+            self.etpids = column ((ep.get ('entityTypePropertyId', -1) for ep in entityProperties), int)
+            self.types = column (((ep.get ('entityTypeProperty') or {}).get ('entityTypePropertyType', -1) for ep in entityProperties), int)
+            self.values = column ((ep.get ('entityPropertyValue') for ep in entityProperties), object)
+        (self.numbers, self.valid) = parseNumbers (self.values)
+
+    def __len__ (self):
+        return len (self.entityIds)
+
+    def __repr__ (self):
+        return "PropertyTable ({0} rows)".format (len (self))
+
+    def select (self, mask):
+        """Table of the rows where mask is True"""
+        return PropertyTable (columns=[c[mask] for c in [self.entityIds, self.etpids, self.types, self.values, self.numbers, self.valid]])
+
+    def entityIdIn (self, entityIds):
+        """mask: entityId is one of entityIds"""
+        if numpy is not None:
+            if not isinstance (entityIds, numpy.ndarray):
+                entityIds = numpy.array (list (entityIds), dtype=int)
+            return numpy.in1d (self.entityIds, entityIds)
+        if not isinstance (entityIds, (set, frozenset)):
+            entityIds = set (entityIds)
+        return column ((e in entityIds for e in self.entityIds), bool)
+
+    def valueIs (self, value, ignoreCase=False):
+        """mask: raw value equals value"""
+        if ignoreCase:
+            value = value.lower ()
+            return column (((v.lower () == value) if isinstance (v, basestring) else False for v in self.values), bool)
+        return column ((v == value for v in self.values), bool)
+
+    def byEntity (self):
+        """{entityId: number}, the last row of an entity wins"""
+        return dict (zip (self.entityIds, self.numbers))
+
+    def lookup (self, other):
+        """Numbers of other for the entityIds of this table
+
+        returns (numbers, found): numbers is nan where found is False
+        """
+        if numpy is not None:
+            # last row of an entity: first one in reversed order
+            (keys, first) = numpy.unique (other.entityIds[::-1], return_index=True)
+            values = other.numbers[::-1][first]
+            if len (keys) == 0:
+                return (numpy.empty (len (self)) * numpy.nan, numpy.zeros (len (self), dtype=bool))
+            positions = numpy.minimum (numpy.searchsorted (keys, self.entityIds), len (keys) - 1)
+            found = keys[positions] == self.entityIds
+            numbers = numpy.where (found, values[positions], numpy.nan)
+            return (numbers, found)
+        mapping = other.byEntity ()
+        found = column ((e in mapping for e in self.entityIds), bool)
+        numbers = column ((mapping.get (e, float ('nan')) for e in self.entityIds), float)
+        return (numbers, found)
+
+
+class Baseline:
+    """Data of the Baseline worldstate used by several indicators for all worldstates of an exercise
+
+    skip: entityIds of the patients not part of the exercise (patientExposedPropertyId is false),
+          numpy array (for PropertyTable.entityIdIn) or frozenset without numpy
+    life: PropertyTable of the patientLifePropertyId values of the participants (integers only)
+    """
+    def __init__ (self, skip, lifeEntityIds, lifeNumbers):
+        self.skip = column (skip, int) if numpy is not None else frozenset (skip)
+        n = len (lifeEntityIds)
+        self.life = PropertyTable (columns=[column (lifeEntityIds, int), column ([patientLifePropertyId] * n, int), column ([1] * n, int),
+                                            column (lifeNumbers, object), column (lifeNumbers, float), column ([True] * n, bool)])
+
+    def __repr__ (self):
+        return "Baseline (skip {0}, life {1})".format (len (self.skip), len (self.life))
+
+    def participants (self, table):
+        """mask: entity of the row is part of the exercise"""
+        return ~table.entityIdIn (self.skip)
+
+baselineNamespace = 'OOI-baseline'
+# (baseUrl, wsid) -> Baseline
+baselines = {}
+
+def getBaseline (wsid, baseUrl=defaultBaseUrl, cached=False):
+    """Baseline data of worldstate wsid (OOI-specific WorldState id of the Baseline)
+
+    Calculated once per exercise: kept for this process and in the LocalStore for all processes.
+    cached: False if the Baseline is the current worldstate (it may still change), see getJson
+    """
+    key = (baseUrl, wsid)
+    with entityPropertiesLock:
+        if key in baselines:
+            return baselines[key]
+    store = LocalStore.getStore ()
+    storeKey = "{0}?wsid={1}".format (baseUrl, wsid)
+    saved = store.get (baselineNamespace, storeKey, touch=True) if cached else None
+    if saved is None:
+        properties = prefetch (wsid, [patientExposedPropertyId, patientLifePropertyId], baseUrl=baseUrl, cached=cached)
+        exposed = PropertyTable (properties[patientExposedPropertyId])
+        skip = exposed.select (exposed.valueIs ("false", ignoreCase=True)).entityIds
+        life = PropertyTable (properties[patientLifePropertyId])
+        life = life.select (~life.entityIdIn (skip) & (life.types == 1) & life.valid)
+        saved = {
+            'skip': [int (e) for e in skip],
+            'lifeEntityIds': [int (e) for e in life.entityIds],
+            'lifeNumbers': [float (n) for n in life.numbers]
+            }
+        if cached:
+            store.put (baselineNamespace, storeKey, saved)
+            store.evict (baselineNamespace, baselineBytes)
+    baseline = Baseline (saved['skip'], saved['lifeEntityIds'], saved['lifeNumbers'])
+    logging.info ("{0} of OOI WorldState {1}".format (baseline, wsid))
+    with entityPropertiesLock:
+        return baselines.setdefault (key, baseline)
+
+
 def getIndicatorRef (wsid, indicatorPropertyId, baseUrl=defaultBaseUrl):
     """get reference (URL) to an indicator within OOI
 
@@ -81,7 +588,7 @@ def getIndicatorRef (wsid, indicatorPropertyId, baseUrl=defaultBaseUrl):
         'etpid' : indicatorPropertyId
         }
     headers = {'content-type': 'application/json'}
-    jsonData = getJson ("{0}/EntityProperty".format (baseUrl), params=params, headers=headers) 
+    jsonData = getJson ("{0}/EntityProperty".format (baseUrl), params=params, headers=headers, cached=False) 
     # count already existing results
     existingResults = 0;
     for ep in jsonData:
@@ -117,7 +624,7 @@ def storeIndicatorValue (wsid, indicatorPropertyId, indicatorValue, indicatorURL
         "worldStateId": wsid,
         }
     if (indicatorURL is None):
-        result = requests.post ("{0}/{1}".format (baseurl, "EntityProperty"), data=json.dumps (indicatorProperty), headers={'content-type': 'application/json'})
+        result = HTTP.post ("{0}/{1}".format (baseurl, "EntityProperty"), data=json.dumps (indicatorProperty), headers={'content-type': 'application/json'})
         if result.status_code != 201:
             raise Exception ("Unable to POST result at {0}/{1}: {2}".format (baseurl, "EntityProperty", result.status_code))
         resultData = result.json() if callable (result.json) else result.json
@@ -126,8 +633,75 @@ def storeIndicatorValue (wsid, indicatorPropertyId, indicatorValue, indicatorURL
     else:
         existingResultId = OOIAccess (indicatorURL).id
         indicatorProperty["entityPropertyId"] = existingResultId
-        result = requests.put (indicatorURL, data=json.dumps (indicatorProperty), headers={'content-type': 'application/json'})
+        result = HTTP.put (indicatorURL, data=json.dumps (indicatorProperty), headers={'content-type': 'application/json'})
         if result.status_code != 200:
             raise Exception ("Unable to PUT result to {0}: {1}".format (indicatorURL, result.status_code))
     return indicatorURL
 
+
+def getIndicatorRefs (wsid, indicatorPropertyIds, baseUrl=defaultBaseUrl):
+    """get references (URL) to several indicators within OOI, see getIndicatorRef
+
+    One request if OOI-WSR supports lists of etpids, otherwise all requests at the same time.
+
+    returns {indicatorPropertyId: indicatorURL or None}
+    """
+    if etpidListSupported and (len (indicatorPropertyIds) > 1):
+        params = {
+            'wsid' :  wsid,
+            'etpid' : ",".join (str (etpid) for etpid in sorted (indicatorPropertyIds))
+            }
+        jsonData = getJson ("{0}/EntityProperty".format (baseUrl), params=params, cached=False)
+        refs = dict ((etpid, None) for etpid in indicatorPropertyIds)
+        for ep in jsonData:
+            if refs.get (ep['entityTypePropertyId']) is not None:
+                raise Exception ("There are already several results for {0}! This should not be the case!".format (ep['entityTypePropertyId']))
+            refs[ep['entityTypePropertyId']] = "{0}/EntityProperty/{1}".format (baseUrl, ep['entityPropertyId'])
+        return refs
+    lookups = [(etpid, ThreadPool.submit (getIndicatorRef, wsid, etpid, baseUrl=baseUrl)) for etpid in indicatorPropertyIds]
+    ThreadPool.wait ([lookup for (etpid, lookup) in lookups])
+    return dict ((etpid, lookup.result ()) for (etpid, lookup) in lookups)
+
+def storeIndicatorValues (wsid, indicatorValues, baseurl=defaultBaseUrl):
+    """store several indicator values of one worldstate
+
+    The existing values are looked up at once (getIndicatorRefs), new and existing
+    values are written with one POST and one PUT if OOI-WSR supports it
+    (bulkStoreSupported), otherwise with one request per value at the same time.
+
+    wsid: OOI-specific WorldState id
+    indicatorValues: {indicatorPropertyId: indicator value}
+
+    returns {indicatorPropertyId: indicatorURL}
+    """
+    refs = getIndicatorRefs (wsid, indicatorValues.keys (), baseUrl=baseurl)
+    if not bulkStoreSupported:
+        stores = [(etpid, ThreadPool.submit (storeIndicatorValue, wsid, etpid, value, indicatorURL=refs[etpid], baseurl=baseurl)) for (etpid, value) in indicatorValues.items ()]
+        ThreadPool.wait ([store for (etpid, store) in stores])
+        return dict ((etpid, store.result ()) for (etpid, store) in stores)
+    newProperties = []
+    existingProperties = []
+    for (etpid, value) in indicatorValues.items ():
+        indicatorProperty = {
+            "entityId" : indicatorEntityId,
+            "entityTypePropertyId": etpid,
+            "entityPropertyValue": json.dumps (value),
+            "worldStateId": wsid,
+            }
+        if refs[etpid] is None:
+            newProperties.append (indicatorProperty)
+        else:
+            indicatorProperty["entityPropertyId"] = OOIAccess (refs[etpid]).id
+            existingProperties.append (indicatorProperty)
+    if len (newProperties) > 0:
+        result = HTTP.post ("{0}/{1}".format (baseurl, "EntityProperty"), data=json.dumps (newProperties), headers={'content-type': 'application/json'})
+        if result.status_code != 201:
+            raise Exception ("Unable to POST results at {0}/{1}: {2}".format (baseurl, "EntityProperty", result.status_code))
+        resultData = result.json() if callable (result.json) else result.json
+        for ep in resultData:
+            refs[ep[u'entityTypePropertyId']] = "{0}/{1}/{2}".format (baseurl, "EntityProperty", ep[u'entityPropertyId'])
+    if len (existingProperties) > 0:
+        result = HTTP.put ("{0}/{1}".format (baseurl, "EntityProperty"), data=json.dumps (existingProperties), headers={'content-type': 'application/json'})
+        if result.status_code != 200:
+            raise Exception ("Unable to PUT results to {0}/{1}: {2}".format (baseurl, "EntityProperty", result.status_code))
+    return refs
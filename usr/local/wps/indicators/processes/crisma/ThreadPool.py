@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Thread pool for overlapping independent ICMM / OOI calls
+#
+# Uses concurrent.futures if it is installed (python-concurrent.futures /
+# pip install futures), otherwise a minimal pool with the same interface:
+#   future = ThreadPool.submit (function, args...)
+#   value = future.result ()
+# Calls submitted from a pool thread go to a second (nested) pool, e.g. the
+# OOI loads of indicators calculated in parallel by AllIndicators. Calls
+# submitted from a nested pool thread are executed at once in that thread,
+# so tasks waiting for other tasks can not block the pools.
+
+######################
+#  Configuration
+maxWorkers = 8            # threads per process, keep <= HTTPtools.poolMaxsize
+maxNestedWorkers = 8      # threads for calls submitted from pool threads
+#####################
+
+import threading
+import Queue
+import sys
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+class Future:
+    """Result of a submitted call (subset of concurrent.futures.Future)"""
+    def __init__ (self):
+        self.event = threading.Event ()
+        self.value = None
+        self.excInfo = None
+        self.cancelled = False
+
+    def cancel (self):
+        """Do not start the call if it is not running yet"""
+        if self.event.is_set ():
+            return False
+        self.cancelled = True
+        return True
+
+    def done (self):
+        return self.event.is_set ()
+
+    def run (self, function, args, kwargs):
+        if not self.cancelled:
+            try:
+                self.value = function (*args, **kwargs)
+            except:
+                self.excInfo = sys.exc_info ()
+        self.event.set ()
+
+    def result (self, timeout=None):
+        """Wait for the call and return its value or raise its exception"""
+        if not self.event.wait (timeout):
+            raise Exception ("Future: no result within {0}s".format (timeout))
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.value
+
+
+class SimpleExecutor:
+    """Minimal ThreadPoolExecutor replacement"""
+    def __init__ (self, max_workers):
+        self.queue = Queue.Queue ()
+        self.threads = []
+        self.maxWorkers = max_workers
+        self.lock = threading.Lock ()
+
+    def worker (self):
+        while True:
+            (future, function, args, kwargs) = self.queue.get ()
+            future.run (function, args, kwargs)
+
+    def submit (self, function, *args, **kwargs):
+        future = Future ()
+        self.queue.put ((future, function, args, kwargs))
+        with self.lock:
+            if len (self.threads) < self.maxWorkers:
+                thread = threading.Thread (target=self.worker)
+                thread.daemon = True    # do not keep the CGI process alive
+                thread.start ()
+                self.threads.append (thread)
+        return future
+
+
+local = threading.local ()
+_executors = {}           # level (0: pool, 1: nested pool) -> executor
+_executorLock = threading.Lock ()
+
+def getExecutor (level=0):
+    if level not in _executors:
+        with _executorLock:
+            if level not in _executors:
+                workers = maxWorkers if level == 0 else maxNestedWorkers
+                if ThreadPoolExecutor is not None:
+                    _executors[level] = ThreadPoolExecutor (max_workers=workers)
+                else:
+                    _executors[level] = SimpleExecutor (max_workers=workers)
+    return _executors[level]
+
+
+def submit (function, *args, **kwargs):
+    """Start function (*args, **kwargs) in the pool (in the nested pool if called from a pool thread)
+
+    returns a Future
+    """
+    level = getattr (local, 'level', 0)
+    if level > 1:
+        future = Future ()
+        future.run (function, args, kwargs)
+        return future
+    return getExecutor (level).submit (poolTask, level + 1, function, *args, **kwargs)
+
+
+def poolTask (level, function, *args, **kwargs):
+    local.level = level
+    return function (*args, **kwargs)
+
+
+def wait (futures):
+    """Wait for all futures
+
+    returns the list of results, raises the first exception (after all calls are finished)
+    """
+    for future in futures:
+        try:
+            future.result ()
+        except:
+            pass
+    return [future.result () for future in futures]
+
+
+def imap (function, items, window=maxWorkers):
+    """Yield function (item) for all items in order, computing up to window of them in advance
+
+    Stopping the iteration early (break, close ()) cancels the calls not started yet.
+    """
+    items = iter (items)
+    futures = []
+    try:
+        while True:
+            while len (futures) < window:
+                try:
+                    item = next (items)
+                except StopIteration:
+                    break
+                futures.append (submit (function, item))
+            if len (futures) == 0:
+                return
+            yield futures.pop (0).result ()
+    finally:
+        for future in futures:
+            future.cancel ()
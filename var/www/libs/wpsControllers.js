@@ -2,7 +2,7 @@ var wpsApp = angular.module ("wpsApp", []);
 var x2js = new X2JS();     
 
 
-wpsApp.controller ('wpsCtrl', function ($scope, $http) {
+wpsApp.controller ('wpsCtrl', function ($scope, $http, $timeout) {
     // default values
     $scope.serverTmp = "https://crisma-pilotC.ait.ac.at"
     $scope.wpsEndpointTmp = $scope.serverTmp + "/indicators/cgi-bin/pywps.cgi";
@@ -273,47 +273,20 @@ wpsApp.controller ('wpsCtrl', function ($scope, $http) {
 
 
 
+    // milliseconds between two reads of the status of a running execution
+    $scope.pollInterval = 2000;
+
     // 	<a href='{{wpsEndpoint}}?service=WPS&request=Execute&version=1.0.0&identifier={{indicator}}&datainputs=ICMMworldstateURL={{worldstateUrl}}' target='Execute'>{{wpsEndpoint}}?service=WPS&request=Execute&version=1.0.0&identifier={{indicator}}&datainputs=ICMMworldstateURL={{worldstateUrl}}</a>
+    // executed asynchronously: the WPS answers with the status location at once
     $scope.executeWPS = function(wsNo, pNo, fp) {
 	var wsUrl = $scope.worldstatesToExecute[wsNo];
 	var process = $scope.processesToExecute[pNo];
 	$http({
 	    method: "GET",
-	    url: $scope.wpsEndpoint + "?service=WPS&request=Execute&version=1.0.0&identifier=" + process + "&datainputs=ICMMworldstateURL=" + wsUrl
+	    url: $scope.wpsEndpoint + "?service=WPS&request=Execute&version=1.0.0&identifier=" + process + "&datainputs=ICMMworldstateURL=" + wsUrl + "&storeExecuteResponse=true&status=true"
 	}).
 	    success(function(data, status, headers, config) {
-		// console.log (data);
-		if (data != null) {
-		    var response = x2js.xml_str2json (data)
-		    // console.log (JSON.stringify (response));
-		    var msgFound = false;
-		    if ('ProcessOutputs' in response.ExecuteResponse) {
-			// search my status output
-			$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "status ProcessOutput missing";
-			for (var o = 0; o < response.ExecuteResponse.ProcessOutputs.Output.length; o++) {
-			    // console.log (JSON.stringify (response.ExecuteResponse.ProcessOutputs.Output[o]))
-			    if ("statusmessage" === response.ExecuteResponse.ProcessOutputs.Output[o].Identifier["__text"]) {
-				$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = response.ExecuteResponse.ProcessOutputs.Output[o].Data.LiteralData["__text"];
-				msgFound = true;
-				break;
-			    }
-			} 
-		    } 
-		    if ((!msgFound) && ('Status' in response.ExecuteResponse) && ('ProcessFailed' in response.ExecuteResponse.Status)) {
-			$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = response.ExecuteResponse.Status.ProcessFailed.ExceptionReport.Exception.ExceptionText["__text"];
-			msgFound = true;
-		    } 
-		    if ((!msgFound) && ('Status' in response.ExecuteResponse) && ('ProcessSucceeded' in response.ExecuteResponse.Status)) {
-			$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = response.ExecuteResponse.Status.ProcessSucceeded["__text"];
-			msgFound = true;
-		    } 
-		    if (!msgFound) {
-			$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "Status missing";
-		    }
-		} else {
-		    $scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "No WPS result";
-		}
-		fp (wsNo, pNo);
+		$scope.onExecuteResponse (data, wsNo, pNo, fp);
 	    }).
 	    error(function(data, status, headers, config) {
 		$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "WPS not available";
@@ -321,6 +294,73 @@ wpsApp.controller ('wpsCtrl', function ($scope, $http) {
 	    });
     };
 
+    // the status location may be relative to the WPS server (outputUrl in pywps.cfg)
+    $scope.statusUrl = function (statusLocation) {
+	if (statusLocation.charAt (0) === "/") {
+	    var server = $scope.wpsEndpoint.match (/^[a-z]+:\/\/[^\/]+/i);
+	    if (server != null) {
+		return server[0] + statusLocation;
+	    }
+	}
+	return statusLocation;
+    };
+
+    // ExecuteResponse or status document: show the progress until the execution is finished
+    $scope.onExecuteResponse = function(data, wsNo, pNo, fp) {
+	var response = (data != null) ? x2js.xml_str2json (data) : null;
+	if ((response != null) && ('Status' in response.ExecuteResponse) &&
+	    (('ProcessAccepted' in response.ExecuteResponse.Status) || ('ProcessStarted' in response.ExecuteResponse.Status))) {
+	    var started = response.ExecuteResponse.Status.ProcessStarted;
+	    $scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = (started == null) ? "accepted" : "running " + started["_percentCompleted"] + "%: " + started["__text"];
+	    var statusLocation = $scope.statusUrl (response.ExecuteResponse["_statusLocation"]);
+	    $timeout (function () {
+		$http({
+		    method: "GET",
+		    url: statusLocation,
+		    params: {t: new Date ().getTime ()}
+		}).
+		    success(function(data, status, headers, config) {
+			$scope.onExecuteResponse (data, wsNo, pNo, fp);
+		    }).
+		    error(function(data, status, headers, config) {
+			$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "WPS status not available";
+			fp (wsNo, pNo);
+		    });
+	    }, $scope.pollInterval);
+	    return;
+	}
+	if (data != null) {
+	    // console.log (JSON.stringify (response));
+	    var msgFound = false;
+	    if ('ProcessOutputs' in response.ExecuteResponse) {
+		// search my status output
+		$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "status ProcessOutput missing";
+		for (var o = 0; o < response.ExecuteResponse.ProcessOutputs.Output.length; o++) {
+		    // console.log (JSON.stringify (response.ExecuteResponse.ProcessOutputs.Output[o]))
+		    if ("statusmessage" === response.ExecuteResponse.ProcessOutputs.Output[o].Identifier["__text"]) {
+			$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = response.ExecuteResponse.ProcessOutputs.Output[o].Data.LiteralData["__text"];
+			msgFound = true;
+			break;
+		    }
+		} 
+	    } 
+	    if ((!msgFound) && ('Status' in response.ExecuteResponse) && ('ProcessFailed' in response.ExecuteResponse.Status)) {
+		$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = response.ExecuteResponse.Status.ProcessFailed.ExceptionReport.Exception.ExceptionText["__text"];
+		msgFound = true;
+	    } 
+	    if ((!msgFound) && ('Status' in response.ExecuteResponse) && ('ProcessSucceeded' in response.ExecuteResponse.Status)) {
+		$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = response.ExecuteResponse.Status.ProcessSucceeded["__text"];
+		msgFound = true;
+	    } 
+	    if (!msgFound) {
+		$scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "Status missing";
+	    }
+	} else {
+	    $scope.results[$scope.worldstatesToExecute[wsNo]][$scope.processesToExecute[pNo]] = "No WPS result";
+	}
+	fp (wsNo, pNo);
+    };
+
 
     $scope.init = function () {
 	$scope.wpsEndpoint = $scope.wpsEndpointTmp;